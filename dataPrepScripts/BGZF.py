@@ -0,0 +1,176 @@
+import zlib
+import shlex
+import struct
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+# A BGZF file is a series of gzip members of at most 64 kb each, with the compressed size of the member in the 'BC'
+# extra subfield. The members are read in batches and inflated in a thread pool, zlib releases the GIL meanwhile.
+# Other gzip files are read through 'gzip -fdc', and uncompressed files are read directly.
+gzipMagic = "\x1f\x8b"
+batchBlocks = 64
+defaultThreads = 4
+
+def IsBGZF(fn):
+    with open(fn, "rb") as f:
+        header = f.read(18)
+    if len(header) < 18 or header[:2] != gzipMagic or ord(header[3]) & 4 == 0:
+        return False
+    return header[12:14] == "BC"
+
+def IsGzip(fn):
+    with open(fn, "rb") as f:
+        return f.read(2) == gzipMagic
+
+def InflateBlock(block):
+    # Inflate the deflate data of a BGZF member, between the header with its extra field and the CRC32/ISIZE trailer
+    xlen = struct.unpack_from("<H", block, 10)[0]
+    return zlib.decompress(block[12+xlen:-8], -15)
+
+
+class LineReader(object):
+    # Lines and reads over a generator of decompressed chunks. The current chunk is consumed from an offset, and
+    # the pieces of a line spanning chunks are joined once, so a long line is not copied again for each chunk
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = ""
+        self.offset = 0
+        self.eof = False
+
+    def Fill(self):
+        # Replace the consumed chunk with the next one
+        try:
+            self.buf = next(self.chunks)
+        except StopIteration:
+            self.buf = ""
+            self.eof = True
+        self.offset = 0
+
+    def readline(self):
+        pieces = []
+        while True:
+            i = self.buf.find("\n", self.offset)
+            if i != -1:
+                pieces.append(self.buf[self.offset:i+1])
+                self.offset = i + 1
+                return "".join(pieces)
+            pieces.append(self.buf[self.offset:])
+            self.offset = len(self.buf)
+            if self.eof:
+                return "".join(pieces)
+            self.Fill()
+
+    def read(self, size = -1):
+        pieces = []
+        length = 0
+        while size < 0 or length < size:
+            if self.offset == len(self.buf):
+                if self.eof:
+                    break
+                self.Fill()
+                continue
+            end = len(self.buf) if size < 0 else min(len(self.buf), self.offset + size - length)
+            pieces.append(self.buf[self.offset:end])
+            length += end - self.offset
+            self.offset = end
+        return "".join(pieces)
+
+    def __iter__(self):
+        # Whole chunks are split at once, only the pieces of the trailing partial line are carried over
+        pieces = []
+        chunk = self.buf[self.offset:]
+        while True:
+            self.buf = ""; self.offset = 0
+            lines = chunk.split("\n")
+            pieces.append(lines[0])
+            if len(lines) > 1:
+                yield "".join(pieces) + "\n"
+                for line in lines[1:-1]:
+                    yield line + "\n"
+                pieces = [lines[-1]]
+            if self.eof:
+                break
+            self.Fill()
+            chunk = self.buf
+        line = "".join(pieces)
+        if line != "":
+            yield line
+
+
+class BGZFReader(LineReader):
+    def __init__(self, fn, threads = defaultThreads, offset = 0):
+        # offset is a BGZF virtual offset, the compressed offset of a member shifted by 16 bits plus the offset
+        # within the inflated member, as found in tabix and BAM indexes
+        self.fh = open(fn, "rb")
+        self.fh.seek(offset >> 16)
+        self.skip = offset & 0xffff
+        self.pool = ThreadPool(threads)
+        LineReader.__init__(self, self.Chunks())
+
+    def Blocks(self):
+        while True:
+            header = self.fh.read(18)
+            if len(header) == 0:
+                return
+            if len(header) < 18 or header[:2] != gzipMagic:
+                raise IOError("Malformed BGZF block")
+            blockSize = struct.unpack_from("<H", header, 16)[0] + 1
+            yield header + self.fh.read(blockSize - 18)
+
+    def Chunks(self):
+        blocks = []
+        for block in self.Blocks():
+            blocks.append(block)
+            if len(blocks) == batchBlocks:
+                for chunk in self.Inflate(blocks):
+                    yield chunk
+                blocks = []
+        for chunk in self.Inflate(blocks):
+            yield chunk
+
+    def Inflate(self, blocks):
+        chunks = self.pool.map(InflateBlock, blocks) if len(blocks) > 1 else [InflateBlock(b) for b in blocks]
+        if self.skip != 0 and len(chunks) != 0:
+            chunks[0] = chunks[0][self.skip:]
+            self.skip = 0
+        return chunks
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.fh.close()
+        return 0
+
+
+class PipeReader(object):
+    # 'gzip -fdc' for the gzip files not in BGZF
+    def __init__(self, fn):
+        self.p = subprocess.Popen(shlex.split("gzip -fdc %s" % (fn) ), stdout=subprocess.PIPE, bufsize=8388608)
+        self.stdout = self.p.stdout
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+    def readline(self):
+        return self.stdout.readline()
+
+    def read(self, size = -1):
+        return self.stdout.read(size)
+
+    def close(self):
+        # The exit status of gzip, non-zero on a corrupt or truncated file
+        self.stdout.close()
+        return self.p.wait()
+
+
+def OpenInput(fn, threads = defaultThreads, offset = 0):
+    # A line iterable with read, readline and close over a BGZF, gzip or uncompressed file. offset is only supported
+    # on BGZF files. A corrupt BGZF block raises IOError or zlib.error, and close returns non-zero on a corrupt gzip file
+    if IsBGZF(fn):
+        return BGZFReader(fn, threads, offset)
+    if offset != 0:
+        raise IOError("%s is not BGZF, cannot start at offset %d" % (fn, offset))
+    if IsGzip(fn):
+        return PipeReader(fn)
+    return open(fn, "rb")
+
@@ -7,9 +7,31 @@ import os
 import re
 import shlex
 import subprocess
+import tempfile
 import signal
+import random
+import bisect
+import multiprocessing
 import gc
+import hashlib
+import struct
+from array import array
 import param
+import RefCache
+import BGZF
+import TensorCache
+try:
+    import pysam
+except ImportError:
+    pysam = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
 
 is_pypy = '__pypy__' in sys.builtin_module_names
 
@@ -18,50 +40,196 @@ def PypyGCCollect(signum, frame):
     signal.alarm(60)
 
 cigarRe = r"(\d+)([MIDNSHP=X])"
+# CIGAR operations are coded as in the BAM format and pysam
+cigarOp = dict(zip("MIDNSHP=X", range(9)))
+BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CREF_SKIP, BAM_CSOFT_CLIP, BAM_CHARD_CLIP, BAM_CPAD, BAM_CEQUAL, BAM_CDIFF = range(9)
+refOps = (BAM_CMATCH, BAM_CDEL, BAM_CREF_SKIP, BAM_CEQUAL, BAM_CDIFF)
 base2num = dict(zip("ACGT", (0,1,2,3)))
 stripe2 = 4 * param.matrixNum
 stripe1 = param.matrixNum
+tensorSize = (2*param.flankingBaseNum+1) * 4 * param.matrixNum
+vectorizedBatchSize = 4096
+if np != None:
+    base2code = np.full(256, 5, dtype=np.int64)
+    for b, c in zip("ACGT-", range(5)):
+        base2code[ord(b)] = c
+
+def CountBase(alnCode, center, refPos, queryAdv, refBase, queryBase):
+    # Add an aligned base of a read into the counts of a center
+    if str(refBase) not in "ACGT-":
+        return
+    if str(queryBase) not in "ACGT-":
+        return
+    if refPos - center >= -(param.flankingBaseNum+1) and refPos - center < param.flankingBaseNum:
+        offset = refPos - center + (param.flankingBaseNum+1)
+        if queryBase != "-":
+            if refBase != "-":
+                alnCode[stripe2*offset + stripe1*base2num[refBase] + 0] += 1.0
+                alnCode[stripe2*offset + stripe1*base2num[queryBase] + 1] += 1.0
+                alnCode[stripe2*offset + stripe1*base2num[refBase] + 2] += 1.0
+                alnCode[stripe2*offset + stripe1*base2num[queryBase] + 3] += 1.0
+            elif refBase == "-":
+                idx = min(offset+queryAdv, 2*param.flankingBaseNum+1-1)
+                alnCode[stripe2*idx + stripe1*base2num[queryBase] + 1] += 1.0
+            else:
+              print >> sys.stderr, "Should not reach here: %s, %s" % (refBase, queryBase)
+        elif queryBase == "-":
+            if refBase != "-":
+                alnCode[stripe2*offset + stripe1*base2num[refBase] + 2] += 1.0
+            else:
+                print >> sys.stderr, "Should not reach here: %s, %s" % (refBase, queryBase)
+        else:
+            print >> sys.stderr, "Should not reach here: %s, %s" % (refBase, queryBase)
 
-def GenerateTensor(ctgName, alns, center, refSeq):
-    alnCode = [0] * ( (2*param.flankingBaseNum+1) * 4 * param.matrixNum )
-    for aln in alns:
-        for refPos, queryAdv, refBase, queryBase in aln:
-            if str(refBase) not in "ACGT-":
-                continue
-            if str(queryBase) not in "ACGT-":
-                continue
-            if refPos - center >= -(param.flankingBaseNum+1) and refPos - center < param.flankingBaseNum:
-                offset = refPos - center + (param.flankingBaseNum+1)
-                if queryBase != "-":
-                    if refBase != "-":
-                        alnCode[stripe2*offset + stripe1*base2num[refBase] + 0] += 1.0
-                        alnCode[stripe2*offset + stripe1*base2num[queryBase] + 1] += 1.0
-                        alnCode[stripe2*offset + stripe1*base2num[refBase] + 2] += 1.0
-                        alnCode[stripe2*offset + stripe1*base2num[queryBase] + 3] += 1.0
-                    elif refBase == "-":
-                        idx = min(offset+queryAdv, 2*param.flankingBaseNum+1-1)
-                        alnCode[stripe2*idx + stripe1*base2num[queryBase] + 1] += 1.0
-                    else:
-                      print >> sys.stderr, "Should not reach here: %s, %s" % (refBase, queryBase)
-                elif queryBase == "-":
-                    if refBase != "-":
-                        alnCode[stripe2*offset + stripe1*base2num[refBase] + 2] += 1.0
-                    else:
-                        print >> sys.stderr, "Should not reach here: %s, %s" % (refBase, queryBase)
-                else:
-                    print >> sys.stderr, "Should not reach here: %s, %s" % (refBase, queryBase)
-
-    newRefPos = center - (0 if args.refStart == None else (args.refStart - 1))
+def TensorWindow(ctgName, center, refSeq, refStart, alnCode):
+    newRefPos = center - (0 if refStart == None else (refStart - 1))
     if (newRefPos - (param.flankingBaseNum+1) >= 0):
-        outputLine = "%s %d %s %s" % (ctgName, center, refSeq[newRefPos-(param.flankingBaseNum+1):newRefPos+param.flankingBaseNum], " ".join("%0.1f" % x for x in alnCode))
-        return outputLine
+        return (ctgName, center, refSeq[newRefPos-(param.flankingBaseNum+1):newRefPos+param.flankingBaseNum], alnCode)
     else:
         return None
 
+def AccumulateReadsNumpy(reads, refSeq, refOffset, candidates, centerToAln):
+    # Vectorized equivalent of WalkRead over a batch of (POS, CIGAR, SEQ) reads. The CIGARs of all the reads are
+    # expanded at once into arrays of aligned (refPos, queryAdv, refBase, queryBase) events, each (read, center) pair
+    # that a read activates gets the events between its activation and its end, and all the pairs are added into the
+    # counts of their centers with a single bincount, so the NumPy calls are paid once per batch instead of per read
+    segRead = []; segOp = []; segRef = []; segQuery = []; segLen = []
+    seqStarts = []; seqLens = []; seqStart = 0
+    for r, (POS, CIGAR, SEQ) in enumerate(reads):
+        refPos = POS; queryPos = 0
+        for op, advance in CIGAR:
+            if op == BAM_CSOFT_CLIP:
+                queryPos += advance
+            if op in (BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF, BAM_CINS, BAM_CDEL) and advance > 0:
+                segRead.append(r); segOp.append(op); segRef.append(refPos); segQuery.append(queryPos); segLen.append(advance)
+                if op != BAM_CINS:
+                    refPos += advance
+                if op != BAM_CDEL:
+                    queryPos += advance
+        seqStarts.append(seqStart); seqLens.append(len(SEQ))
+        seqStart += len(SEQ) + 1
+    if len(segLen) == 0:
+        return
+    segLen = np.array(segLen, dtype=np.int64)
+    segIdx = np.repeat(np.arange(len(segLen)), segLen)
+    within = np.arange(len(segIdx)) - np.repeat(np.cumsum(segLen) - segLen, segLen)
+    evOp = np.array(segOp, dtype=np.int64)[segIdx]
+    evIns = evOp == BAM_CINS; evDel = evOp == BAM_CDEL
+    evRead = np.array(segRead, dtype=np.int64)[segIdx]
+    evRefPos = np.array(segRef, dtype=np.int64)[segIdx] + np.where(evIns, 0, within)
+    evQueryPos = np.array(segQuery, dtype=np.int64)[segIdx] + within
+    evQueryAdv = np.where(evIns, within, 0)
+
+    # Base codes: 0-3 for ACGT, 4 for "-", 5 for anything else, including the query positions past the end of SEQ
+    lo = evRefPos.min(); hi = evRefPos.max()
+    refCodes = np.full(hi - lo + 1, 5, dtype=np.int64)
+    refSegment = refSeq[lo - refOffset:hi - refOffset + 1]
+    refCodes[:len(refSegment)] = base2code[np.frombuffer(refSegment, dtype=np.uint8)]
+    refCode = np.where(evIns, 4, refCodes[evRefPos - lo])
+    queryCodes = base2code[np.frombuffer("\0".join(SEQ for POS, CIGAR, SEQ in reads) + "\0", dtype=np.uint8)]
+    evQueryPos = np.array(seqStarts, dtype=np.int64)[evRead] + np.minimum(evQueryPos, np.array(seqLens, dtype=np.int64)[evRead])
+    queryCode = np.where(evDel, 4, queryCodes[evQueryPos])
+
+    # The center activated at each reference position is the last loaded candidate whose window covers the position,
+    # a (read, center) pair starts at its first activating event, after it if that is a deletion
+    flanking = param.flankingBaseNum + 1
+    numCandidates = len(candidates)
+    idx = np.searchsorted(candidates, evRefPos + flanking, side="right") - 1
+    activating = np.flatnonzero((idx >= 0) & (candidates[np.maximum(idx, 0)] > evRefPos - flanking) & ~evIns)
+    if len(activating) == 0:
+        return
+    pairKeys, first = np.unique(evRead[activating] * numCandidates + idx[activating], return_index=True)
+    pairStart = activating[first]
+    pairStart += evDel[pairStart]
+    pairCenter = candidates[pairKeys % numCandidates]
+
+    # A pair ends at the event of its read at center + flanking, included, or at the end of the read
+    j = np.searchsorted(candidates, evRefPos - flanking, side="right") - 1
+    ending = np.flatnonzero((j >= 0) & (candidates[np.maximum(j, 0)] == evRefPos - flanking) & ~evIns)
+    endKeys = evRead[ending] * numCandidates + j[ending]
+    k = np.minimum(np.searchsorted(endKeys, pairKeys), max(len(endKeys) - 1, 0))
+    readEnd = np.searchsorted(evRead, np.arange(len(reads)), side="right")
+    if len(endKeys) != 0:
+        pairEnd = np.where(endKeys[k] == pairKeys, ending[k] + 1, readEnd[pairKeys // numCandidates])
+    else:
+        pairEnd = readEnd[pairKeys // numCandidates]
+
+    centers, slot = np.unique(pairCenter, return_inverse=True)
+    lengths = np.maximum(pairEnd - pairStart, 0)
+    ev = np.repeat(pairStart, lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    base = np.repeat(slot, lengths) * tensorSize
+    offset = evRefPos[ev] - np.repeat(pairCenter, lengths) + flanking
+    r = refCode[ev]; q = queryCode[ev]
+    inWindow = (offset >= 0) & (offset < 2*param.flankingBaseNum+1)
+    match = inWindow & (r < 4) & (q < 4)
+    insertion = inWindow & (r == 4) & (q < 4)
+    deletion = inWindow & (r < 4) & (q == 4)
+    insOffset = np.minimum(offset[insertion] + evQueryAdv[ev][insertion], 2*param.flankingBaseNum)
+    matchBase = base[match] + stripe2*offset[match]
+    counts = np.bincount(np.concatenate((
+        matchBase + stripe1*r[match] + 0,
+        matchBase + stripe1*q[match] + 1,
+        matchBase + stripe1*r[match] + 2,
+        matchBase + stripe1*q[match] + 3,
+        base[insertion] + stripe2*insOffset + stripe1*q[insertion] + 1,
+        base[deletion] + stripe2*offset[deletion] + stripe1*r[deletion] + 2)), minlength=len(centers)*tensorSize)
+    counts = counts.reshape(len(centers), tensorSize).astype(np.float64)
+    for i, center in enumerate(centers.tolist()):
+        if center in centerToAln:
+            centerToAln[center] += counts[i]
+        else:
+            centerToAln[center] = counts[i]
+
+def TensorToText(tensor):
+    ctgName, center, refWindow, alnCode = tensor
+    return "%s %d %s %s" % (ctgName, center, refWindow, " ".join("%0.1f" % x for x in alnCode))
+
+class BinaryTensorWriter(object):
+    # Write the tensors in blocks of fixed-size records after param.tensorMagic. A block has a header
+    # (param.tensorBlockHeader: number of records, bytes per count, blosc compressed or not, length of the
+    # chromosome name and length of the payload) followed by the chromosome name and the payload. A record is the
+    # uint32 position, the reference window and the counts as the smallest unsigned integer holding the block maximum
+    def __init__(self, handle, compress):
+        self.handle = handle
+        self.compress = compress
+        self.tensors = []
+        self.handle.write(param.tensorMagic)
+
+    def write(self, tensor):
+        if len(self.tensors) != 0 and tensor[0] != self.tensors[0][0]:
+            self.flush()
+        self.tensors.append(tensor)
+        if len(self.tensors) >= param.tensorBlockSize:
+            self.flush()
+
+    def flush(self):
+        if len(self.tensors) == 0:
+            return
+        ctgName = self.tensors[0][0]
+        maxCount = max(max(alnCode) for _, _, _, alnCode in self.tensors)
+        typecode, width = ("B", 1) if maxCount < 256 else (("H", 2) if maxCount < 65536 else ("I", 4))
+        windowFormat = "<I%ds" % (2*param.flankingBaseNum+1)
+        records = []
+        for _, center, refWindow, alnCode in self.tensors:
+            counts = array(typecode, [int(x) for x in alnCode])
+            if sys.byteorder == "big": counts.byteswap()
+            records.append(struct.pack(windowFormat, center, refWindow))
+            records.append(counts.tostring())
+        payload = "".join(records)
+        if self.compress == True:
+            payload = blosc.compress(payload, typesize=1)
+        self.handle.write(struct.pack(param.tensorBlockHeader, len(self.tensors), width, self.compress, len(ctgName), len(payload)))
+        self.handle.write(ctgName)
+        self.handle.write(payload)
+        self.tensors = []
+
+    def close(self):
+        self.flush()
+        self.handle.close()
+
 def GetCandidate(args, beginToEnd):
     if args.can_fn != "PIPE":
-        f = subprocess.Popen(shlex.split("gzip -fdc %s" % (args.can_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
-        fo = f.stdout
+        fo = BGZF.OpenInput(args.can_fn)
     else:
         fo = sys.stdin
     for row in fo:
@@ -73,10 +241,9 @@ def GetCandidate(args, beginToEnd):
 
     if args.can_fn != "PIPE":
         fo.close()
-        f.wait()
 
-def GetReads(args, canSites):
-    regions = []
+def GetRegions(args, canSites):
+    # Merge the windows around the candidate sites into 1-based inclusive regions
     prevStart = -1
     prevEnd = -1
     for pos in canSites:
@@ -88,23 +255,70 @@ def GetReads(args, canSites):
             prevEnd = pos + param.expandReadsRegion
             continue
         else:
-            regions.append("%s:%d-%d" % (args.ctgName, prevStart, prevEnd))
+            yield prevStart, prevEnd
             prevStart = pos - param.expandReadsRegion if pos - param.expandReadsRegion > 0 else 1
             prevEnd = pos + param.expandReadsRegion
-        if len(regions) == 128:
-            p = subprocess.Popen(shlex.split("%s view %s %s" % (args.samtools, args.bam_fn, " ".join(regions)) ), stdout=subprocess.PIPE, bufsize=8388608)
-            for row in p.stdout:
-                yield row
-            p.stdout.close()
-            p.wait()
-            regions = []
     if prevStart != -1 and prevEnd != -1:
-        regions.append("%s:%d-%d" % (args.ctgName, prevStart, prevEnd))
-    p = subprocess.Popen(shlex.split("%s view %s %s" % (args.samtools, args.bam_fn, " ".join(regions)) ), stdout=subprocess.PIPE, bufsize=8388608)
-    for row in p.stdout:
-        yield row
-    p.stdout.close()
-    p.wait()
+        yield prevStart, prevEnd
+
+def ParseSAMRecord(row):
+    # Return (RNAME, 0-based POS, [(CIGAR op, length), ...], SEQ) from a SAM line
+    l = row.split()
+    if l[0][0] == "@":
+        return None
+    CIGAR = [(cigarOp[op], int(advance)) for advance, op in re.findall(cigarRe, l[5])]
+    return l[2], int(l[3]) - 1, CIGAR, l[9]
+
+def GetReadsSamtools(args, canSites):
+    # All the regions go to a single 'samtools view -M', its multi-region iterator returns each read once in order
+    bed_fh = tempfile.NamedTemporaryFile(prefix="skyhawk.", suffix=".bed", delete=False)
+    numRegions = 0
+    for start, end in GetRegions(args, canSites):
+        bed_fh.write("%s\t%d\t%d\n" % (args.ctgName, start - 1, end))
+        numRegions += 1
+    bed_fh.close()
+    try:
+        if numRegions == 0:
+            return
+        p = subprocess.Popen(shlex.split("%s view -M -L %s -F %d -q %d %s" % (args.samtools, bed_fh.name, args.excludeFlags, args.minMQ, args.bam_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
+        for row in p.stdout:
+            read = ParseSAMRecord(row)
+            if read != None:
+                yield read
+        p.stdout.close()
+        p.wait()
+        if p.returncode != 0:
+            print >> sys.stderr, "'samtools view -M' failed, samtools 1.8 or later is required"
+            sys.exit(1)
+    finally:
+        os.remove(bed_fh.name)
+
+bamFiles = {}
+
+def GetReadsPysam(args, canSites):
+    # The BAM is opened once per process and the regions are fetched through its index
+    if args.bam_fn not in bamFiles:
+        bamFiles[args.bam_fn] = pysam.AlignmentFile(args.bam_fn, "rb")
+    bam = bamFiles[args.bam_fn]
+    prevEnd = 0
+    for start, end in GetRegions(args, canSites):
+        for read in bam.fetch(args.ctgName, start - 1, end):
+            # A read starting before the end of the previous region has been returned by that region
+            if read.reference_start < prevEnd:
+                continue
+            if read.flag & args.excludeFlags != 0 or read.mapping_quality < args.minMQ:
+                continue
+            yield read.reference_name, read.reference_start, read.cigartuples or [], read.query_sequence or "*"
+        prevEnd = end
+
+def GetReads(args, canSites):
+    # Yield (RNAME, 0-based POS, [(CIGAR op, length), ...], SEQ) for the reads around the candidate sites
+    if getattr(args, "pysam", False) == True:
+        if pysam == None:
+            print >> sys.stderr, "Failed to import pysam, please install pysam or disable --pysam"
+            sys.exit(1)
+        return GetReadsPysam(args, canSites)
+    return GetReadsSamtools(args, canSites)
 
 class TensorStdout(object):
     def __init__(self, handle):
@@ -113,9 +327,15 @@ class TensorStdout(object):
     def __del__(self):
         self.stdin.close()
 
-def OutputAlnTensor(args):
-    availableSlots = 10000000
-    dcov = args.dcov
+def LoadReferenceCache(args, offset):
+    # The reference from a cache built by RefCache.py, decoded lazily from the memory-mapped file
+    refCache = RefCache.OpenRefCache(args.refCache_fn)
+    if args.ctgName not in refCache.contigs or offset >= refCache.Length(args.ctgName):
+        print >> sys.stderr, "Failed to load reference seqeunce. Please check if the provided reference cache %s and the ctgName %s are correct." % (args.refCache_fn, args.ctgName)
+        sys.exit(1)
+    return refCache.Sequence(args.ctgName, offset)
+
+def LoadReference(args):
     args.refStart = None; args.refEnd = None; refSeq = []; refName = None; rowCount = 0
     if args.ctgStart != None and args.ctgEnd != None:
         args.ctgStart += 1 # Change 0-based (BED) to 1-based (VCF and samtools faidx)
@@ -123,9 +343,13 @@ def OutputAlnTensor(args):
         args.refStart -= param.expandReferenceRegion
         args.refStart = 1 if args.refStart < 1 else args.refStart
         args.refEnd += param.expandReferenceRegion
+        if args.refCache_fn != None:
+            return LoadReferenceCache(args, args.refStart - 1)
         p1 = subprocess.Popen(shlex.split("%s faidx %s %s:%d-%d" % (args.samtools, args.ref_fn, args.ctgName, args.refStart, args.refEnd) ), stdout=subprocess.PIPE, bufsize=8388608)
     else:
         args.ctgStart = args.ctgEnd = None
+        if args.refCache_fn != None:
+            return LoadReferenceCache(args, 0)
         p1 = subprocess.Popen(shlex.split("%s faidx %s %s" % (args.samtools, args.ref_fn, args.ctgName) ), stdout=subprocess.PIPE, bufsize=8388608)
 
     for row in p1.stdout:
@@ -143,22 +367,116 @@ def OutputAlnTensor(args):
         print >> sys.stderr, "Failed to load reference seqeunce. Please check if the provided reference fasta %s and the ctgName %s are correct." % (args.ref_fn, args.ctgName)
         sys.exit(1)
 
+    return refSeq
+
+def WalkRead(POS, CIGAR, SEQ, refSeq, refOffset, beginToEnd, centerToAln, onlyCenter = None):
+    # Add the aligned bases of a read into the counts of the centers it covers, or of onlyCenter alone if given
+    refPos = POS
+    queryPos = 0
+    endToCenter = {}
+    activeSet = set()
+    for op, advance in CIGAR:
+        if op == BAM_CSOFT_CLIP:
+            queryPos += advance
+        if op in (BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF):
+            for i in xrange(advance):
+                if refPos in beginToEnd:
+                    rEnd, rCenter = beginToEnd[refPos]
+                    if rCenter not in activeSet and (onlyCenter == None or rCenter == onlyCenter):
+                        endToCenter[rEnd] = rCenter
+                        activeSet.add(rCenter)
+                        if rCenter not in centerToAln:
+                            centerToAln[rCenter] = [0.0] * tensorSize
+                for center in activeSet:
+                    CountBase(centerToAln[center], center, refPos, 0, refSeq[refPos - refOffset], SEQ[queryPos])
+                if refPos in endToCenter:
+                    center = endToCenter[refPos]
+                    activeSet.remove(center)
+                refPos += 1
+                queryPos += 1
+
+        elif op == BAM_CINS:
+            queryAdv = 0
+            for i in range(advance):
+                for center in activeSet:
+                    CountBase(centerToAln[center], center, refPos, queryAdv, "-", SEQ[queryPos])
+                queryPos += 1
+                queryAdv += 1
+
+        elif op == BAM_CDEL:
+            for i in xrange(advance):
+                for center in activeSet:
+                    CountBase(centerToAln[center], center, refPos, 0, refSeq[refPos - refOffset], "-")
+                if refPos in beginToEnd:
+                    rEnd, rCenter = beginToEnd[refPos]
+                    if rCenter not in activeSet and (onlyCenter == None or rCenter == onlyCenter):
+                        endToCenter[rEnd] = rCenter
+                        activeSet.add(rCenter)
+                        if rCenter not in centerToAln:
+                            centerToAln[rCenter] = [0.0] * tensorSize
+                if refPos in endToCenter:
+                    center = endToCenter[refPos]
+                    activeSet.remove(center)
+                refPos += 1
+
+def SampleRead(reservoirs, center, read, maxDepth, seed):
+    # Algorithm R, keep a uniform sample of maxDepth among the reads covering a center. The random numbers are
+    # seeded per center, so the sample does not depend on the other centers nor on the chunking by --workers
+    if center not in reservoirs:
+        reservoirs[center] = [0, [], None]
+    reservoir = reservoirs[center]
+    reservoir[0] += 1
+    if len(reservoir[1]) < maxDepth:
+        reservoir[1].append(read)
+        return
+    if reservoir[2] == None:
+        reservoir[2] = random.Random(seed * 1000003 + center)
+    i = reservoir[2].randint(0, reservoir[0] - 1)
+    if i < maxDepth:
+        reservoir[1][i] = read
+
+def WalkReservoirs(reservoirs, closeBefore, refSeq, refOffset, beginToEnd, centerToAln):
+    # Count the sampled reads of the centers with a window ending before closeBefore, or of all the centers if None
+    for center in sorted(reservoirs.keys()):
+        if closeBefore == None or center + (param.flankingBaseNum+1) < closeBefore:
+            for POS, CIGAR, SEQ in reservoirs[center][1]:
+                WalkRead(POS, CIGAR, SEQ, refSeq, refOffset, beginToEnd, centerToAln, center)
+            del reservoirs[center]
+
+def GenerateTensors(args, canSites, refSeq):
+    # Yield a (ctgName, center, refWindow, alnCode) tensor for each candidate site. The aligned bases are added
+    # into the counts of the centers as the reads stream through, the memory scales with the number of open centers
+    dcov = args.dcov
+    numBypassed = 0; bypassedPos = set(); numOutOfOrder = 0
     beginToEnd = {}
     centerToAln = {}
 
     canPos = 0
-    canGen = GetCandidate(args, beginToEnd)
-    canSites = []
-    for pos in canGen:
-        canSites.append(pos)
     p2 = GetReads(args, canSites)
     iterCanSites = iter(canSites)
 
-    if args.tensor_fn != "PIPE":
-        tensor_fpo = open(args.tensor_fn, "wb")
-        tensor_fp = subprocess.Popen(shlex.split("gzip -c"), stdin=subprocess.PIPE, stdout=tensor_fpo, stderr=sys.stderr, bufsize=8388608)
-    else:
-        tensor_fp = TensorStdout(sys.stdout)
+    vectorized = getattr(args, "vectorized", False)
+    if vectorized == True:
+        if np == None:
+            print >> sys.stderr, "Failed to import numpy, please install numpy or disable --vectorized"
+            sys.exit(1)
+        if any(canSites[i] > canSites[i+1] for i in xrange(len(canSites)-1)):
+            print >> sys.stderr, "Candidate sites are not sorted, --vectorized is disabled"
+            vectorized = False
+        candidates = np.array(canSites, dtype=np.int64)
+    # With --vectorized the reads are counted in batches, a batch is counted before the first center it may reach
+    # closes, or when it is full
+    batch = []; batchCloseBefore = None
+
+    # With --maxDepth the reads are only walked when their centers close, each center over its own sample
+    maxDepth = getattr(args, "maxDepth", 0)
+    reservoirs = {}
+    if maxDepth > 0:
+        if any(canSites[i] > canSites[i+1] for i in xrange(len(canSites)-1)):
+            print >> sys.stderr, "Candidate sites are not sorted, --maxDepth is disabled"
+            maxDepth = 0
+        vectorized = False
+    refOffset = 0 if args.refStart == None else (args.refStart - 1)
 
     #if is_pypy:
     #    signal.signal(signal.SIGALRM, PypyGCCollect)
@@ -166,31 +484,16 @@ def OutputAlnTensor(args):
 
     previousPos = 0; depthCap = 0
     lastChr = ""; lastPos = -1
-    for l in p2:
-        l = l.split()
-        if l[0][0] == "@":
-            continue
-
-        QNAME = l[0]
-        FLAG = int(l[1])
-        RNAME = l[2]
-        POS = int(l[3]) - 1 # switch from 1-base to 0-base to match sequence index
-        CIGAR = l[5]
-        SEQ = l[9]
-        refPos = POS
-        queryPos = 0
-
+    for RNAME, POS, CIGAR, SEQ in p2:
         if RNAME != lastChr:
             lastChr = RNAME
             lastPos = POS
         elif lastPos <= POS:
             lastPos = POS
         else:
+            numOutOfOrder += 1
             continue
 
-        endToCenter = {}
-        activeSet = set()
-
         while canPos != -1 and canPos < (POS + len(SEQ) + 100000):
             try:
                 canPos = next(iterCanSites)
@@ -206,81 +509,187 @@ def OutputAlnTensor(args):
             depthCap += 1
             if depthCap >= dcov:
                 #print >> sys.stderr, "Bypassing POS %d at depth %d\n" % (POS, depthCap)
+                numBypassed += 1
+                bypassedPos.add(POS)
                 continue
 
-        for m in re.finditer(cigarRe, CIGAR):
-            if availableSlots == 0:
-                break
-            advance = int(m.group(1))
-            if m.group(2) == "S":
-                queryPos += advance
-            if m.group(2) in ("M", "=", "X"):
-                for i in xrange(advance):
-                    if refPos in beginToEnd:
-                        rEnd, rCenter = beginToEnd[refPos]
-                        if rCenter not in activeSet:
-                            endToCenter[rEnd] = rCenter
-                            activeSet.add(rCenter)
-                            #if rCenter == 133300025 and rCenter not in centerToAln.keys():
-                            #    print >> sys.stderr, "ins", l, RNAME, POS, CIGAR
-                            centerToAln.setdefault(rCenter, [])
-                            centerToAln[rCenter].append([])
-                    for center in list(activeSet):
-                        if availableSlots != 0:
-                            availableSlots -= 1
-                            centerToAln[center][-1].append( (refPos, 0, refSeq[refPos - (0 if args.refStart == None else (args.refStart - 1))], SEQ[queryPos] ) )
-                    if refPos in endToCenter:
-                        center = endToCenter[refPos]
-                        activeSet.remove(center)
-                    refPos += 1
-                    queryPos += 1
-
-            elif m.group(2) == "I":
-                queryAdv = 0
-                for i in range(advance):
-                    for center in list(activeSet):
-                        if availableSlots != 0:
-                            availableSlots -= 1
-                            centerToAln[center][-1].append( (refPos, queryAdv, "-", SEQ[queryPos] ))
-                    queryPos += 1
-                    queryAdv += 1
-
-            elif m.group(2) == "D":
-                for i in xrange(advance):
-                    for center in list(activeSet):
-                        if availableSlots != 0:
-                            availableSlots -= 1
-                            centerToAln[center][-1].append( (refPos, 0, refSeq[refPos - (0 if args.refStart == None else (args.refStart - 1))], "-" ))
-                    if refPos in beginToEnd:
-                        rEnd, rCenter = beginToEnd[refPos]
-                        if rCenter not in activeSet:
-                            endToCenter[rEnd] = rCenter
-                            activeSet.add(rCenter)
-                            centerToAln.setdefault(rCenter, [])
-                            centerToAln[rCenter].append([])
-                    if refPos in endToCenter:
-                        center = endToCenter[refPos]
-                        activeSet.remove(center)
-                    refPos += 1
+        if maxDepth > 0:
+            refEnd = POS + sum(advance for op, advance in CIGAR if op in refOps)
+            lo = bisect.bisect_right(canSites, POS - (param.flankingBaseNum+1))
+            hi = bisect.bisect_left(canSites, refEnd + (param.flankingBaseNum+1))
+            for i in xrange(lo, hi):
+                if i == lo or canSites[i] != canSites[i-1]:
+                    SampleRead(reservoirs, canSites[i], (POS, CIGAR, SEQ), maxDepth, args.seed)
+        elif vectorized == True:
+            if len(batch) == 0:
+                i = bisect.bisect_right(canSites, POS - (param.flankingBaseNum+1))
+                batchCloseBefore = canSites[i] + (param.flankingBaseNum+1) if i < len(canSites) else None
+            batch.append((POS, CIGAR, SEQ))
+            if len(batch) >= vectorizedBatchSize:
+                AccumulateReadsNumpy(batch, refSeq, refOffset, candidates, centerToAln)
+                batch = []
+        else:
+            WalkRead(POS, CIGAR, SEQ, refSeq, refOffset, beginToEnd, centerToAln)
 
         if depthCap == 0: # Run once at each position
-            for center in centerToAln.keys():
+            if maxDepth > 0:
+                WalkReservoirs(reservoirs, POS, refSeq, refOffset, beginToEnd, centerToAln)
+            if vectorized == True and len(batch) != 0 and batchCloseBefore != None and batchCloseBefore < POS:
+                AccumulateReadsNumpy(batch, refSeq, refOffset, candidates, centerToAln)
+                batch = []
+            for center in sorted(centerToAln.keys()):
                 if center + (param.flankingBaseNum+1) < POS:
-                    o =  GenerateTensor(args.ctgName, centerToAln[center], center, refSeq)
+                    alnCode = centerToAln[center].tolist() if vectorized == True else centerToAln[center]
+                    o = TensorWindow(args.ctgName, center, refSeq, args.refStart, alnCode)
                     if o != None:
-                        tensor_fp.stdin.write(o)
-                        tensor_fp.stdin.write("\n")
-                    availableSlots += sum(len(i) for i in centerToAln[center])
-                    #print >> sys.stderr, "POS %d: remaining slots %d" % (center, availableSlots)
+                        yield o
                     #if center == 133300025:
                     #    print >> sys.stderr, "del", l, RNAME, POS, CIGAR
                     del centerToAln[center]
 
-    for center in centerToAln.keys():
-        l =  GenerateTensor(args.ctgName, centerToAln[center], center, refSeq)
+    if maxDepth > 0:
+        WalkReservoirs(reservoirs, None, refSeq, refOffset, beginToEnd, centerToAln)
+    if vectorized == True and len(batch) != 0:
+        AccumulateReadsNumpy(batch, refSeq, refOffset, candidates, centerToAln)
+    for center in sorted(centerToAln.keys()):
+        alnCode = centerToAln[center].tolist() if vectorized == True else centerToAln[center]
+        l = TensorWindow(args.ctgName, center, refSeq, args.refStart, alnCode)
         if l != None:
-            tensor_fp.stdin.write(l)
-            tensor_fp.stdin.write("\n")
+            yield l
+
+    if numOutOfOrder != 0:
+        print >> sys.stderr, "%d out of order reads on %s dropped, is the BAM sorted?" % (numOutOfOrder, args.ctgName)
+    if numBypassed != 0:
+        print >> sys.stderr, "Depth cap (--dcov %d) hit on %s: %d reads bypassed at %d positions" % (dcov, args.ctgName, numBypassed, len(bypassedPos))
+
+def SplitCandidates(canSites, chunkSize):
+    # Split sorted candidate sites into chunks of at least chunkSize sites, only at gaps wider than the read regions
+    # around the sites, so no read is needed by two chunks
+    chunk = []
+    for pos in canSites:
+        if len(chunk) >= chunkSize and pos - chunk[-1] > 2 * param.expandReadsRegion:
+            yield chunk
+            chunk = []
+        chunk.append(pos)
+    if len(chunk) != 0:
+        yield chunk
+
+workerArgs = None; workerRefSeq = None
+
+def GenerateTensorsWorker(canSites):
+    # The arguments and the reference are inherited from the parent when the pool forks
+    return list(GenerateTensors(workerArgs, canSites, workerRefSeq))
+
+def GenerateTensorsParallel(args, canSites, refSeq):
+    # GenerateTensors on chunks of the candidate sites in --workers processes, the tensors are yielded in candidate order
+    global workerArgs, workerRefSeq
+    if args.workers > 1 and any(canSites[i] > canSites[i+1] for i in xrange(len(canSites)-1)):
+        print >> sys.stderr, "Candidate sites are not sorted, --workers is disabled"
+        args.workers = 1
+    if args.workers <= 1 or len(canSites) == 0:
+        for tensor in GenerateTensors(args, canSites, refSeq):
+            yield tensor
+        return
+
+    workerArgs = args; workerRefSeq = refSeq
+    pool = multiprocessing.Pool(args.workers)
+    chunkSize = max(len(canSites) / (args.workers * 4), 1)
+    for tensors in pool.imap(GenerateTensorsWorker, SplitCandidates(canSites, chunkSize)):
+        for tensor in tensors:
+            yield tensor
+    pool.close()
+    pool.join()
+
+def FileIdentity(fn):
+    st = os.stat(fn)
+    return "%s:%d:%d" % (os.path.realpath(fn), st.st_size, int(st.st_mtime))
+
+def TensorCacheKey(args):
+    # The BAM, the reference as loaded by LoadReference, from the cache if given, and all the parameters changing the
+    # tensors
+    key = "|".join([FileIdentity(args.bam_fn), FileIdentity(args.refCache_fn if args.refCache_fn != None else args.ref_fn),
+                    "%d,%d,%d,%d,%d,%d,%d,%d" % (param.flankingBaseNum, param.matrixNum, param.expandReadsRegion,
+                                                 args.dcov, args.maxDepth, args.seed, args.excludeFlags, args.minMQ)])
+    return hashlib.sha1(key).hexdigest()
+
+def TensorContexts(positions):
+    # The offsets of the other sorted candidate sites sharing window positions with each site, they change its tensor
+    contexts = {}
+    span = 2 * (param.flankingBaseNum+1)
+    lo = 0
+    for i, pos in enumerate(positions):
+        while positions[lo] <= pos - span:
+            lo += 1
+        hi = i + 1
+        while hi < len(positions) and positions[hi] < pos + span:
+            hi += 1
+        contexts[pos] = ",".join(str(positions[j] - pos) for j in xrange(lo, hi) if j != i)
+    return contexts
+
+def GenerateTensorsCached(args, canSites, refSeq):
+    # GenerateTensorsParallel on the candidate sites missing from the --tensorCache_fn cache, merged with the cached
+    # tensors in candidate order. Sites sharing reads are rebuilt together if any of them is missing
+    if args.tensorCache_fn != None and any(canSites[i] > canSites[i+1] for i in xrange(len(canSites)-1)):
+        print >> sys.stderr, "Candidate sites are not sorted, --tensorCache_fn is disabled"
+        args.tensorCache_fn = None
+    if args.tensorCache_fn == None:
+        for tensor in GenerateTensorsParallel(args, canSites, refSeq):
+            yield tensor
+        return
+
+    cache = TensorCache.TensorCache(args.tensorCache_fn, args.tensorCacheSize * 1048576, TensorCacheKey(args))
+    positions = sorted(set(canSites))
+    contexts = TensorContexts(positions)
+    cached = cache.Cached(args.ctgName, contexts)
+    toBuild = []
+    for chunk in SplitCandidates(positions, 1):
+        if any(pos not in cached for pos in chunk):
+            toBuild.extend(chunk)
+    print >> sys.stderr, "Tensor cache: %d of %d sites on %s cached, building %d" % (len(cached), len(positions), args.ctgName, len(toBuild))
+
+    toBuildSet = set(toBuild)
+    built = GenerateTensorsParallel(args, toBuild, refSeq)
+    nextBuilt = next(built, None)
+    for pos in positions:
+        if pos not in toBuildSet:
+            tensor = cache.Get(args.ctgName, pos, cached[pos])
+        else:
+            tensor = None
+            if nextBuilt != None and nextBuilt[1] == pos:
+                tensor = nextBuilt
+                nextBuilt = next(built, None)
+            cache.Put(args.ctgName, pos, contexts[pos], tensor)
+        if tensor != None:
+            yield tensor
+    cache.Close()
+
+def OutputAlnTensor(args):
+    refSeq = LoadReference(args)
+
+    canGen = GetCandidate(args, {})
+    canSites = []
+    for pos in canGen:
+        canSites.append(pos)
+
+    if args.tensorFormat == "binary":
+        if args.tensorBlosc == True and blosc == None:
+            print >> sys.stderr, "blosc is required by --tensorBlosc"
+            sys.exit(1)
+        writer = BinaryTensorWriter(open(args.tensor_fn, "wb") if args.tensor_fn != "PIPE" else sys.stdout, args.tensorBlosc)
+        for tensor in GenerateTensorsCached(args, canSites, refSeq):
+            writer.write(tensor)
+        writer.close()
+        return
+
+    if args.tensor_fn != "PIPE":
+        tensor_fpo = open(args.tensor_fn, "wb")
+        tensor_fp = subprocess.Popen(shlex.split("gzip -c"), stdin=subprocess.PIPE, stdout=tensor_fpo, stderr=sys.stderr, bufsize=8388608)
+    else:
+        tensor_fp = TensorStdout(sys.stdout)
+
+    for tensor in GenerateTensorsCached(args, canSites, refSeq):
+        tensor_fp.stdin.write(TensorToText(tensor))
+        tensor_fp.stdin.write("\n")
 
     if args.tensor_fn != "PIPE":
         tensor_fp.stdin.close()
@@ -305,6 +714,12 @@ if __name__ == "__main__":
     parser.add_argument('--tensor_fn', type=str, default="PIPE",
             help="Tensor output, use PIPE for standard output, default: %(default)s")
 
+    parser.add_argument('--tensorFormat', type=str, default="text", choices=["text", "binary"],
+            help="Tensor output format, text is gzipped unless using standard output, binary is read by GetTensor without parsing, default: %(default)s")
+
+    parser.add_argument('--tensorBlosc', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Compress the binary tensor blocks with blosc, default: %(default)s")
+
     parser.add_argument('--ctgName', type=str, default="chr17",
             help="The name of sequence to be processed, default: %(default)s")
 
@@ -315,11 +730,41 @@ if __name__ == "__main__":
             help="The inclusive ending position of the sequence to be processed")
 
     parser.add_argument('--samtools', type=str, default="samtools",
-            help="Path to the 'samtools', default: %(default)s")
+            help="Path to the 'samtools', version 1.8 or later, default: %(default)s")
+
+    parser.add_argument('--refCache_fn', type=str, default=None,
+            help="Reference cache built by RefCache.py, used instead of 'samtools faidx' on the reference fasta if provided")
+
+    parser.add_argument('--excludeFlags', type=int, default=0,
+            help="Skip the reads with any of these FLAG bits set when reading the BAM, e.g. 3844 for unmapped, secondary, QC-fail, duplicate and supplementary reads, default: %(default)s")
+
+    parser.add_argument('--minMQ', type=int, default=0,
+            help="Skip the reads with a MAPQ below this when reading the BAM, default: %(default)s")
 
     parser.add_argument('--dcov', type=int, default=250,
             help="Cap depth per position at %(default)s")
 
+    parser.add_argument('--maxDepth', type=int, default=0,
+            help="Build each tensor from a random sample of at most this many reads covering the site, 0 to use all the reads, default: %(default)s")
+
+    parser.add_argument('--seed', type=int, default=0,
+            help="Random seed of --maxDepth, default: %(default)s")
+
+    parser.add_argument('--tensorCache_fn', type=str, default=None,
+            help="Persistent tensor cache, only the sites not in the cache are built, disabled if not provided")
+
+    parser.add_argument('--tensorCacheSize', type=int, default=10240,
+            help="Size limit of the tensor cache in MB, the least recently used tensors are evicted beyond it, default: %(default)s")
+
+    parser.add_argument('--workers', type=int, default=1,
+            help="Number of processes building the tensors on separate chunks of the candidate sites, default: %(default)s")
+
+    parser.add_argument('--vectorized', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Build the tensors with the vectorized NumPy engine, the output is identical, faster than the Python walk in CPython but not in pypy, default: %(default)s")
+
+    parser.add_argument('--pysam', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Read the BAM through pysam instead of 'samtools view', default: %(default)s")
+
     args = parser.parse_args()
 
     if len(sys.argv[1:]) == 0:
@@ -3,6 +3,7 @@ import argparse
 import subprocess
 import shlex
 import os
+import BGZF
 
 class TruthStdout(object):
     def __init__(self, handle):
@@ -26,6 +27,53 @@ def CheckCmdExist(cmd):
     return cmd
 
 
+def ConvertVariants( vcf_fp, ctgName, ctgStart, ctgEnd ):
+    # Yield [ctgName, pos, ref, alt, p1, p2] for each VCF record in the 1-based inclusive region
+    for row in vcf_fp:
+        row = row.strip().split()
+        if row[0][0] == "#":
+            continue
+        if row[0] != ctgName:
+            continue
+        if ctgStart != None and ctgEnd != None:
+            if int(row[1]) < ctgStart or int(row[1]) > ctgEnd:
+                continue
+        yield ConvertRecord( row )
+
+
+def ConvertAllVariants( vcf_fp ):
+    # Yield [ctgName, pos, ref, alt, p1, p2] for the VCF records of all the contigs, in the order of the VCF
+    for row in vcf_fp:
+        row = row.strip().split()
+        if row[0][0] == "#":
+            continue
+        yield ConvertRecord( row )
+
+
+def ConvertRecord( row ):
+    # [ctgName, pos, ref, alt, p1, p2] of a split VCF record
+    last = row[-1]
+    p1, p2 = 0, 0
+    if last.split(":")[0].find("/") != -1 or last.split(":")[0].find("|") != -1:
+        varType = last.split(":")[0].replace("/","|").replace(".","0").split("|")
+        p1, p2 = [int(x) for x in varType]
+        p1, p2 = (p1, p2) if p1 < p2 else (p2, p1)
+    else:
+        varType = last.split(":")[0].replace(".","0")
+        p1 = p2 = int(varType)
+    if p1 == 1 and p2 == 2 and row[4].find(",") != -1:
+        p1, p2 = 0, 1
+        gts = row[4].split(",")
+        shortestLen = 99
+        shortestGT = ""
+        for i in gts:
+            if len(i) < shortestLen:
+                shortestLen = len(i)
+                shortestGT = i
+        row[4] = shortestGT
+    return [row[0], row[1], row[3], row[4], str(p1), str(p2)]
+
+
 def OutputVariant( args ):
     var_fn = args.var_fn
     vcf_fn = args.vcf_fn
@@ -41,53 +89,28 @@ def OutputVariant( args ):
     else:
         var_fp = TruthStdout(sys.stdout)
 
+    # Jump to the region, or to the whole contig, through the tabix index if there is one
     tabixed = 0;
-    if ctgStart != None and ctgEnd != None:
-        if vcf_fn != "PIPE":
-            if CheckFileExist("%s.tbi" % (vcf_fn)) != None:
-                if CheckCmdExist("tabix") != None:
-                    tabixed = 1
-                    vcf_fpo = subprocess.Popen(shlex.split("tabix -f -p vcf %s %s:%s-%s" % (vcf_fn, ctgName, ctgStart, ctgEnd) ), stdout=subprocess.PIPE, bufsize=8388608)
-                    vcf_fp = vcf_fpo.stdout
+    if vcf_fn != "PIPE":
+        if CheckFileExist("%s.tbi" % (vcf_fn)) != None:
+            if CheckCmdExist("tabix") != None:
+                tabixed = 1
+                region = "%s:%s-%s" % (ctgName, ctgStart, ctgEnd) if ctgStart != None and ctgEnd != None else ctgName
+                vcf_fpo = subprocess.Popen(shlex.split("tabix -f -p vcf %s %s" % (vcf_fn, region) ), stdout=subprocess.PIPE, bufsize=8388608)
+                vcf_fp = vcf_fpo.stdout
     if tabixed == 0:
         if vcf_fn != "PIPE":
-            vcf_fpo = subprocess.Popen(shlex.split("gzip -fdc %s" % (vcf_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
-            vcf_fp = vcf_fpo.stdout
+            vcf_fp = BGZF.OpenInput(vcf_fn)
         else:
             vcf_fp = sys.stdin
-    for row in vcf_fp:
-        row = row.strip().split()
-        if row[0][0] == "#":
-            continue
-        if row[0] != ctgName:
-            continue
-        if ctgStart != None and ctgEnd != None:
-            if int(row[1]) < ctgStart or int(row[1]) > ctgEnd:
-                continue
-        last = row[-1]
-        p1, p2 = 0, 0
-        if last.split(":")[0].find("/") != -1 or last.split(":")[0].find("|") != -1:
-            varType = last.split(":")[0].replace("/","|").replace(".","0").split("|")
-            p1, p2 = [int(x) for x in varType]
-            p1, p2 = (p1, p2) if p1 < p2 else (p2, p1)
-        else:
-            varType = last.split(":")[0].replace(".","0")
-            p1 = p2 = int(varType)
-        if p1 == 1 and p2 == 2 and row[4].find(",") != -1:
-            p1, p2 = 0, 1
-            gts = row[4].split(",")
-            shortestLen = 99
-            shortestGT = ""
-            for i in gts:
-                if len(i) < shortestLen:
-                    shortestLen = len(i)
-                    shortestGT = i
-            row[4] = shortestGT
-        var_fp.stdin.write(" ".join([row[0], row[1], row[3], row[4], str(p1), str(p2)]))
+    for record in ConvertVariants( vcf_fp, ctgName, ctgStart, ctgEnd ):
+        var_fp.stdin.write(" ".join(record))
         var_fp.stdin.write("\n")
-    if vcf_fn != "PIPE":
+    if tabixed == 1:
         vcf_fpo.stdout.close()
         vcf_fpo.wait()
+    elif vcf_fn != "PIPE":
+        vcf_fp.close()
 
     if args.var_fn != "PIPE":
         var_fp.stdin.close()
@@ -95,6 +118,39 @@ def OutputVariant( args ):
         var_fpo.close()
 
 
+def OutputAllVariants( args ):
+    # Read the VCF once and write the variants of each contig to var_prefix followed by the contig name. The records of
+    # a contig must be together, as in a sorted VCF, so that a single output is open at a time
+    if args.vcf_fn != "PIPE":
+        vcf_fp = BGZF.OpenInput(args.vcf_fn)
+    else:
+        vcf_fp = sys.stdin
+
+    ctgName = None; written = set()
+    var_fpo = None; var_fp = None
+    for record in ConvertAllVariants( vcf_fp ):
+        if record[0] != ctgName:
+            if var_fp != None:
+                var_fp.stdin.close()
+                var_fp.wait()
+                var_fpo.close()
+            ctgName = record[0]
+            if ctgName in written:
+                sys.exit("Please make sure the records of each contig are together in the VCF input, %s is found again" % (ctgName))
+            var_fpo = open(args.var_prefix + ctgName, "wb")
+            var_fp = subprocess.Popen(shlex.split("gzip -c" ), stdin=subprocess.PIPE, stdout=var_fpo, stderr=sys.stderr, bufsize=8388608)
+            written.add(ctgName)
+        var_fp.stdin.write(" ".join(record))
+        var_fp.stdin.write("\n")
+    if var_fp != None:
+        var_fp.stdin.close()
+        var_fp.wait()
+        var_fpo.close()
+
+    if args.vcf_fn != "PIPE":
+        vcf_fp.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
             description="Extract variant type and allele from a Truth dataset" )
@@ -105,6 +161,9 @@ if __name__ == "__main__":
     parser.add_argument('--var_fn', type=str, default="PIPE",
             help="Truth variants list output, use PIPE for standard output, default: %(default)s")
 
+    parser.add_argument('--var_prefix', type=str, default=None,
+            help="Read the VCF once and write the truth variants list of every contig to this prefix followed by the contig name, the records of each contig must be together in the VCF, --var_fn, --ctgName, --ctgStart and --ctgEnd are ignored")
+
     parser.add_argument('--ctgName', type=str, default="chr17",
             help="The name of sequence to be processed, default: %(default)s")
 
@@ -120,5 +179,8 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
-    OutputVariant( args )
+    if args.var_prefix != None:
+        OutputAllVariants( args )
+    else:
+        OutputVariant( args )
 
@@ -0,0 +1,204 @@
+import sys
+import os
+import re
+import mmap
+import json
+import zlib
+import struct
+import bisect
+import argparse
+from array import array
+from collections import OrderedDict
+import BGZF
+
+# A reference cache file holds, for each contig, the bases packed into 2 bits (A:0, C:1, G:2, T:3, four bases per
+# byte with the first base in the highest bits), the runs of non-ACGT bases (run starts, run ends and the base of
+# each run) and the runs of lowercase (soft-masked) bases. The file ends with a JSON index of the contigs and a
+# trailer pointing to the index. The file is memory-mapped read-only, so all the workers share the same pages.
+magic = "SKYREF01"
+trailerFormat = "<QQ8s"
+blockSize = 65536
+maxCachedBlocks = 64
+
+code2bases = ["".join("ACGT"[(b >> s) & 3] for s in (6, 4, 2, 0)) for b in range(256)]
+bases2code = dict((bases, chr(b)) for b, bases in enumerate(code2bases))
+toACGT = "".join(chr(i) if chr(i) in "ACGT" else "A" for i in range(256))
+nonACGTRe = re.compile(r"([^ACGT])\1*")
+lowercaseRe = re.compile(r"[a-z]+")
+
+
+def PackContig(out_fh, seq):
+    # Write a contig at the current end of the cache file, return its index entry
+    entry = {"length": len(seq)}
+    upper = seq.upper()
+
+    entry["seq"] = out_fh.tell()
+    packed = upper.translate(toACGT)
+    packed += "A" * (-len(packed) % 4)
+    out_fh.write("".join([bases2code[packed[i:i+4]] for i in xrange(0, len(packed), 4)]))
+
+    starts = array("I"); ends = array("I"); chars = []
+    for m in nonACGTRe.finditer(upper):
+        starts.append(m.start()); ends.append(m.end()); chars.append(m.group(1))
+    entry["exc"] = [out_fh.tell(), len(starts)]
+    out_fh.write(starts.tostring()); out_fh.write(ends.tostring())
+    entry["excChars"] = out_fh.tell()
+    out_fh.write("".join(chars))
+
+    starts = array("I"); ends = array("I")
+    for m in lowercaseRe.finditer(seq):
+        starts.append(m.start()); ends.append(m.end())
+    entry["lower"] = [out_fh.tell(), len(starts)]
+    out_fh.write(starts.tostring()); out_fh.write(ends.tostring())
+    return entry
+
+
+def BuildRefCache(ref_fn, cache_fn):
+    if array("I").itemsize != 4:
+        sys.exit("Unsupported platform, unsigned int is not 4 bytes")
+    tmp_fn = "%s.%d.tmp" % (cache_fn, os.getpid())
+    index = {"byteorder": sys.byteorder, "contigs": {}}
+    f = BGZF.OpenInput(ref_fn)
+    try:
+        with open(tmp_fn, "wb") as out_fh:
+            out_fh.write(magic)
+            ctgName = None; seq = []
+            for row in f:
+                if row[0] == ">":
+                    if ctgName != None:
+                        index["contigs"][ctgName] = PackContig(out_fh, "".join(seq))
+                    ctgName = row[1:].split()[0]; seq = []
+                    continue
+                seq.append(row.strip())
+            if ctgName != None:
+                index["contigs"][ctgName] = PackContig(out_fh, "".join(seq))
+            indexStr = json.dumps(index)
+            indexOffset = out_fh.tell()
+            out_fh.write(indexStr)
+            out_fh.write(struct.pack(trailerFormat, indexOffset, len(indexStr), magic))
+        returncode = f.close()
+    except (IOError, zlib.error, struct.error) as e:
+        print >> sys.stderr, e
+        returncode = 1
+    if returncode not in (None, 0):
+        os.remove(tmp_fn)
+        sys.exit("Failed to read the reference fasta %s" % (ref_fn))
+    os.rename(tmp_fn, cache_fn)
+
+
+class UInt32Array(object):
+    # A read-only uint32 array in the mapped file, usable by bisect
+    def __init__(self, mm, offset, count, fmt):
+        self.mm = mm; self.offset = offset; self.count = count; self.fmt = fmt
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return struct.unpack_from(self.fmt, self.mm, self.offset + 4 * i)[0]
+
+
+class RefCache(object):
+    def __init__(self, cache_fn):
+        self.fh = open(cache_fn, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        trailerSize = struct.calcsize(trailerFormat)
+        indexOffset, indexLength, trailerMagic = struct.unpack(trailerFormat, self.mm[len(self.mm)-trailerSize:])
+        if self.mm[:len(magic)] != magic or trailerMagic != magic:
+            sys.exit("%s is not a reference cache" % (cache_fn))
+        index = json.loads(self.mm[indexOffset:indexOffset+indexLength])
+        fmt = "<I" if index["byteorder"] == "little" else ">I"
+        self.contigs = {}
+        for ctgName, entry in index["contigs"].iteritems():
+            excOffset, excCount = entry["exc"]
+            lowerOffset, lowerCount = entry["lower"]
+            self.contigs[str(ctgName)] = (entry["length"], entry["seq"],
+                UInt32Array(self.mm, excOffset, excCount, fmt), UInt32Array(self.mm, excOffset + 4 * excCount, excCount, fmt), entry["excChars"],
+                UInt32Array(self.mm, lowerOffset, lowerCount, fmt), UInt32Array(self.mm, lowerOffset + 4 * lowerCount, lowerCount, fmt))
+
+    def Length(self, ctgName):
+        return self.contigs[ctgName][0]
+
+    def Fetch(self, ctgName, start, end):
+        # The bases of a contig in the 0-based half-open region [start, end), with case and non-ACGT bases kept
+        length, seqOffset, excStarts, excEnds, excChars, lowerStarts, lowerEnds = self.contigs[ctgName]
+        start = max(start, 0); end = min(end, length)
+        if start >= end:
+            return ""
+        b0 = start >> 2; b1 = (end + 3) >> 2
+        s = bytearray("".join([code2bases[ord(c)] for c in self.mm[seqOffset+b0:seqOffset+b1]])[start-4*b0:end-4*b0])
+        i = bisect.bisect_right(excEnds, start)
+        while i < len(excStarts) and excStarts[i] < end:
+            a = max(excStarts[i], start); b = min(excEnds[i], end)
+            s[a-start:b-start] = self.mm[excChars+i] * (b - a)
+            i += 1
+        i = bisect.bisect_right(lowerEnds, start)
+        while i < len(lowerStarts) and lowerStarts[i] < end:
+            a = max(lowerStarts[i], start); b = min(lowerEnds[i], end)
+            s[a-start:b-start] = s[a-start:b-start].lower()
+            i += 1
+        return str(s)
+
+    def Sequence(self, ctgName, offset = 0):
+        return RefSequence(self, ctgName, offset)
+
+
+class RefSequence(object):
+    # A contig from the position offset onwards, indexed and sliced like a string but decoded block by block on access
+    def __init__(self, cache, ctgName, offset):
+        self.cache = cache; self.ctgName = ctgName; self.offset = offset
+        self.length = max(cache.Length(ctgName) - offset, 0)
+        self.blocks = OrderedDict()
+        self.lastBlock = -1; self.lastSeq = ""
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            s = self.cache.Fetch(self.ctgName, self.offset + start, self.offset + stop)
+            return s if step == 1 else s[::step]
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError("reference position out of range")
+        p = self.offset + i
+        block = p / blockSize
+        if block != self.lastBlock:
+            if block not in self.blocks:
+                if len(self.blocks) >= maxCachedBlocks:
+                    self.blocks.popitem(last=False)
+                self.blocks[block] = self.cache.Fetch(self.ctgName, block * blockSize, (block + 1) * blockSize)
+            self.lastBlock = block; self.lastSeq = self.blocks[block]
+        return self.lastSeq[p - block * blockSize]
+
+
+refCaches = {}
+
+def OpenRefCache(cache_fn):
+    # Each process maps a cache file once
+    if cache_fn not in refCaches:
+        refCaches[cache_fn] = RefCache(cache_fn)
+    return refCaches[cache_fn]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            description="Build a 2-bit packed, memory-mapped reference cache from a fasta file" )
+
+    parser.add_argument('--ref_fn', type=str, default="ref.fa",
+            help="Reference fasta file input, gzipped or not, default: %(default)s")
+
+    parser.add_argument('--cache_fn', type=str, default=None,
+            help="Reference cache output, default: the reference fasta file name with a .refcache suffix")
+
+    args = parser.parse_args()
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    BuildRefCache(args.ref_fn, args.cache_fn if args.cache_fn != None else args.ref_fn + ".refcache")
+
@@ -0,0 +1,80 @@
+import time
+import zlib
+import sqlite3
+from array import array
+
+# A persistent cache of tensors in a sqlite database. Each tensor is keyed by a dataset key, identifying the BAM,
+# the reference and the tensor parameters, the contig and the position. The context of a tensor, the candidate
+# sites close enough to share its window, is stored with it, a tensor built in another context is not reused. A site
+# without tensor is cached with a NULL window. The least recently used tensors are evicted when the cache grows
+# beyond its size limit.
+putBatchSize = 1000
+
+class TensorCache(object):
+    def __init__(self, cache_fn, maxSize, dataset):
+        self.db = sqlite3.connect(cache_fn, timeout=3600)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tensors (dataset TEXT, ctg TEXT, pos INTEGER, context TEXT, window TEXT, counts BLOB, size INTEGER, used REAL, PRIMARY KEY (dataset, ctg, pos))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tensorsUsed ON tensors (used)")
+        self.db.commit()
+        self.maxSize = maxSize
+        self.dataset = dataset
+        self.puts = []
+
+    def Cached(self, ctgName, contexts):
+        # The entries found in the cache with the same context, by position, marked as used now so that other processes
+        # will evict them last. The entries are read in a single query, so that an eviction by another process
+        # afterwards cannot take away a site reported as cached
+        positions = contexts.keys()
+        if len(positions) == 0:
+            return {}
+        lo = min(positions); hi = max(positions)
+        self.db.execute("UPDATE tensors SET used = ? WHERE dataset = ? AND ctg = ? AND pos BETWEEN ? AND ?", (time.time(), self.dataset, ctgName, lo, hi))
+        self.db.commit()
+        rows = self.db.execute("SELECT pos, context, window, counts FROM tensors WHERE dataset = ? AND ctg = ? AND pos BETWEEN ? AND ?", (self.dataset, ctgName, lo, hi))
+        return dict((pos, (window, counts)) for pos, context, window, counts in rows if contexts.get(pos) == context)
+
+    def Get(self, ctgName, pos, entry):
+        # The tensor of an entry returned by Cached, None for a site cached without tensor
+        window, counts = entry
+        if window == None:
+            return None
+        alnCode = array("I")
+        alnCode.fromstring(zlib.decompress(str(counts)))
+        return (ctgName, pos, window, [float(x) for x in alnCode])
+
+    def Put(self, ctgName, pos, context, tensor):
+        if tensor == None:
+            self.puts.append((self.dataset, ctgName, pos, context, None, None, 64 + len(context), time.time()))
+        else:
+            counts = zlib.compress(array("I", [int(x) for x in tensor[3]]).tostring())
+            self.puts.append((self.dataset, ctgName, pos, context, tensor[2], sqlite3.Binary(counts), 64 + len(context) + len(tensor[2]) + len(counts), time.time()))
+        if len(self.puts) >= putBatchSize:
+            self.Flush()
+
+    def Flush(self):
+        if len(self.puts) == 0:
+            return
+        self.db.executemany("INSERT OR REPLACE INTO tensors VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.puts)
+        self.db.commit()
+        self.puts = []
+
+    def Evict(self):
+        # Remove the least recently used tensors of all datasets until the cache fits in maxSize
+        total = self.db.execute("SELECT SUM(size) FROM tensors").fetchone()[0]
+        if total == None or total <= self.maxSize:
+            return
+        rowids = []
+        for rowid, size in self.db.execute("SELECT rowid, size FROM tensors ORDER BY used"):
+            rowids.append((rowid,))
+            total -= size
+            if total <= self.maxSize:
+                break
+        self.db.executemany("DELETE FROM tensors WHERE rowid = ?", rowids)
+        self.db.commit()
+
+    def Close(self):
+        self.Flush()
+        self.Evict()
+        self.db.close()
@@ -2,6 +2,9 @@ flankingBaseNum = 16
 matrixNum = 4
 expandReferenceRegion = 1000000
 expandReadsRegion = 300
+tensorMagic = "SKYTNS01"
+tensorBlockHeader = "<IBBHI"
+tensorBlockSize = 2000
 
 
 def str2bool(v):
@@ -0,0 +1,132 @@
+import sys
+import os
+import json
+import time
+import socket
+import argparse
+import multiprocessing
+from threading import Thread
+import numpy as np
+import param
+
+# A profile holds, for each host, the fastest predict batch size and intra-op and inter-op thread numbers measured on
+# synthetic tensors. The best setting depends on the CPU budget and on the number of models running at once, so a
+# profile is kept for each pair of them.
+batchSizes = (500, 1000, 2000, 4000, 8000)
+interThreads = (1, 2)
+
+def ProfilePath(profile_fn = None):
+    if profile_fn != None:
+        return profile_fn
+    return os.path.join(os.path.expanduser("~"), ".skyhawk", "profile.%s.json" % (socket.gethostname()))
+
+def ProfileKey(numCpus, numModels):
+    return "%d/%d" % (numCpus, numModels)
+
+def LoadProfile(profile_fn, numCpus, numModels):
+    # The setting calibrated for this CPU budget and number of models, None if not calibrated
+    fn = ProfilePath(profile_fn)
+    if not os.path.isfile(fn):
+        return None
+    with open(fn) as f:
+        return json.load(f).get(ProfileKey(numCpus, numModels))
+
+def SaveProfile(profile_fn, numCpus, numModels, setting):
+    fn = ProfilePath(profile_fn)
+    profiles = {}
+    if os.path.isfile(fn):
+        with open(fn) as f:
+            profiles = json.load(f)
+    elif not os.path.isdir(os.path.dirname(os.path.abspath(fn))):
+        os.makedirs(os.path.dirname(os.path.abspath(fn)))
+    profiles[ProfileKey(numCpus, numModels)] = setting
+    with open(fn + ".tmp", "w") as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.rename(fn + ".tmp", fn)
+
+def ApplyProfile(setting):
+    param.predictBatchSize = setting["batchSize"]
+    param.NUM_THREADS = setting["intraThreads"]
+    param.NUM_INTER_THREADS = setting["interThreads"]
+
+def SyntheticTensors(num, seed = 0):
+    # Poisson read counts, with the insertion, deletion and SNP channels relative to the reference channel as in
+    # the tensors of CreateTensorSites
+    X = np.random.RandomState(seed).poisson(20, size=(num, 2*param.flankingBaseNum+1, 4, param.matrixNum)).astype(np.float32)
+    for i in range(1, param.matrixNum): X[:,:,:,i] -= X[:,:,:,0]
+    return X
+
+def IntraThreads(numThreads):
+    # Powers of two up to the threads of a model, and all its threads
+    candidates = set([numThreads])
+    i = 1
+    while i < numThreads:
+        candidates.add(i)
+        i *= 2
+    return sorted(candidates)
+
+def Benchmark(models, X, batchSize):
+    # Tensors per second with all the models predicting concurrently on their own share of X
+    def Predict(m, X):
+        for i in range(0, len(X), batchSize):
+            m.predict(X[i:i+batchSize])
+    share = len(X) / len(models)
+    threads = [Thread(target=Predict, args=(m, X[i*share:(i+1)*share])) for i, m in enumerate(models)]
+    start = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return share * len(models) / (time.time() - start)
+
+def Calibrate(args):
+    import utils_v2 as utils
+    import clairvoyante_test as vv
+    utils.SetupEnv()
+    if args.threads == None: numCpus = multiprocessing.cpu_count()
+    else: numCpus = args.threads if args.threads < multiprocessing.cpu_count() else multiprocessing.cpu_count()
+    numModels = args.inferenceWorkers if args.inferenceWorkers > 1 else 1
+    numThreads = numCpus / numModels if numCpus >= numModels else 1
+    X = SyntheticTensors(args.numTensors)
+    best = None
+    for intra in IntraThreads(numThreads):
+        for inter in interThreads:
+            param.NUM_THREADS = intra; param.NUM_INTER_THREADS = inter
+            models = [vv.LoadModel(args.chkpnt_fn) for i in range(numModels)]
+            Benchmark(models, X[:numModels * batchSizes[0]], batchSizes[0])
+            for batchSize in batchSizes:
+                speed = Benchmark(models, X, batchSize)
+                print >> sys.stderr, "intraThreads %d, interThreads %d, batchSize %d: %.0f tensors/s" % (intra, inter, batchSize, speed)
+                if best == None or speed > best["tensorsPerSecond"]:
+                    best = {"batchSize": batchSize, "intraThreads": intra, "interThreads": inter, "tensorsPerSecond": speed}
+            for m in models: m.close()
+    SaveProfile(args.profile_fn, numCpus, numModels, best)
+    print >> sys.stderr, "Best for %d threads and %d models: intraThreads %d, interThreads %d, batchSize %d, saved to %s" %\
+        (numCpus, numModels, best["intraThreads"], best["interThreads"], best["batchSize"], ProfilePath(args.profile_fn))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            description="Benchmark the predict batch size and the tensorflow thread numbers on this host, and save the fastest for validateVar.py" )
+
+    parser.add_argument('--chkpnt_fn', type=str, default = None,
+            help="Input a Clairvoyante model")
+
+    parser.add_argument('--threads', type=int, default = None,
+            help="Number of threads, as given to validateVar.py, optional")
+
+    parser.add_argument('--inferenceWorkers', type=int, default = 1,
+            help="Number of model instances loaded for inference, as given to validateVar.py, default: %(default)s")
+
+    parser.add_argument('--numTensors', type=int, default = 40000,
+            help="Number of synthetic tensors predicted for each setting, default: %(default)s")
+
+    parser.add_argument('--profile_fn', type=str, default = None,
+            help="Output profile, default: ~/.skyhawk/profile.<hostname>.json")
+
+    args = parser.parse_args()
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    Calibrate(args)
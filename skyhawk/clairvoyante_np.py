@@ -0,0 +1,272 @@
+import sys
+import os
+import argparse
+import numpy as np
+import param
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../dataPrepScripts")
+import BGZF
+
+# NumPy implementation of the inference of clairvoyante_v3.Clairvoyante. The weights are read from a .npz file
+# exported by this script, or from a checkpoint if tensorflow is available. Dropout is an identity at inference.
+# The weights can be exported in float16, or in int8 with a scale per output channel. An int8 model also rounds the
+# input of each layer but the first to int8, with scales calibrated on sample tensors. NumPy has no float16 or int8
+# matrix multiplication, the weights are expanded to float32 once when loaded and the arithmetic stays in float32, so
+# a reduced precision only makes the file smaller and shows how the calls would change, it is not faster.
+layerNames = ("conv1", "conv2", "conv3", "fc4", "fc5", "YBaseChangeSigmoid", "YZygosityFC", "YVarTypeFC", "YIndelLengthFC")
+precisions = ("float32", "float16", "int8")
+seluAlpha = 1.6732632423543772848170429916717
+seluScale = 1.0507009873554804934193349852946
+epsilon = 1e-10
+
+def Selu(x):
+    return seluScale * np.where(x >= 0.0, x, seluAlpha * np.expm1(np.minimum(x, 0.0)))
+
+def Sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+def Softmax(x):
+    e = np.exp(x - np.max(x, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
+
+def Conv2DSame(x, kernel, bias):
+    # NHWC convolution with stride 1 and "same" padding, the extra padding goes after as in tensorflow
+    kh, kw, cin, cout = kernel.shape
+    n, h, w, _ = x.shape
+    xp = np.pad(x, ((0, 0), ((kh-1)//2, kh-1-(kh-1)//2), ((kw-1)//2, kw-1-(kw-1)//2), (0, 0)), mode="constant")
+    out = np.empty((n * h * w, cout), dtype=x.dtype)
+    out[:] = bias
+    for i in range(kh):
+        for j in range(kw):
+            out += np.dot(xp[:, i:i+h, j:j+w, :].reshape(-1, cin), kernel[i, j])
+    return out.reshape(n, h, w, cout)
+
+def MaxPoolValid(x, poolSize):
+    # Max pooling with stride 1 and "valid" padding
+    ph, pw = poolSize
+    h = x.shape[1] - ph + 1; w = x.shape[2] - pw + 1
+    out = x[:, 0:h, 0:w, :].copy()
+    for i in range(ph):
+        for j in range(pw):
+            np.maximum(out, x[:, i:i+h, j:j+w, :], out=out)
+    return out
+
+def ReadCheckpoint(chkpnt_fn):
+    # The kernels and biases of a tensorflow checkpoint, tensorflow is only needed here
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(chkpnt_fn)
+    weights = {}
+    for name in layerNames:
+        weights[name + "/kernel"] = reader.get_tensor(name + "/kernel")
+        weights[name + "/bias"] = reader.get_tensor(name + "/bias")
+    return weights
+
+
+class Clairvoyante(object):
+
+    def __init__(self, pollSize1 = (5, 1), pollSize2 = (4, 1), pollSize3 = (3, 1)):
+        self.pollSize1 = pollSize1; self.pollSize2 = pollSize2; self.pollSize3 = pollSize3
+        self.weights = None; self.kernels = None; self.precision = "float32"; self.inputRanges = None
+        self.predictBaseRTVal = None; self.predictZygosityRTVal = None; self.predictVarTypeRTVal = None; self.predictIndelLengthRTVal = None
+
+    def init(self):
+        pass
+
+    def close(self):
+        pass
+
+    def restoreParameters(self, fn):
+        if fn.endswith(".npz"):
+            with np.load(fn) as f:
+                weights = dict((k, f[k]) for k in f.files)
+        else:
+            weights = ReadCheckpoint(fn)
+        self.precision = str(weights.pop("precision", "float32"))
+        self.weights = dict((k, np.ascontiguousarray(v, dtype=v.dtype if v.dtype in (np.int8, np.float16) else np.float32)) for k, v in weights.items())
+        self.Dequantize()
+
+    def Dequantize(self):
+        # The float32 kernels used by predict, expanded once from the stored weights
+        self.kernels = {}
+        for name in layerNames:
+            kernel = self.weights[name + "/kernel"]
+            if kernel.dtype == np.int8:
+                kernel = kernel.astype(np.float32) * self.weights[name + "/kernelScale"]
+            self.kernels[name] = np.ascontiguousarray(kernel, dtype=np.float32)
+
+    def saveParameters(self, fn):
+        np.savez(fn, precision=np.array(self.precision), **self.weights)
+
+    def quantize(self, precision, XArray = None):
+        # A copy of a float32 model in float16, or in int8 with the input scales calibrated on the tensors XArray
+        m = Clairvoyante(self.pollSize1, self.pollSize2, self.pollSize3)
+        m.precision = precision
+        m.weights = dict(self.weights)
+        if precision == "float16":
+            for name in layerNames:
+                m.weights[name + "/kernel"] = self.weights[name + "/kernel"].astype(np.float16)
+        elif precision == "int8":
+            for name in layerNames:
+                kernel = self.weights[name + "/kernel"]
+                scale = np.max(np.abs(kernel.reshape(-1, kernel.shape[-1])), axis=0) / 127.0
+                scale[scale == 0] = 1.0
+                m.weights[name + "/kernel"] = np.clip(np.rint(kernel / scale), -127, 127).astype(np.int8)
+                m.weights[name + "/kernelScale"] = scale.astype(np.float32)
+            self.inputRanges = {}
+            for i in range(0, len(XArray), 2000):
+                self.predict(XArray[i:i+2000])
+            for name, r in self.inputRanges.items():
+                m.weights[name + "/inputScale"] = np.float32(r / 127.0 if r > 0 else 1.0)
+            self.inputRanges = None
+        m.Dequantize()
+        return m
+
+    def Input(self, x, name):
+        # The input of a layer, rounded to int8 in an int8 model, its range recorded during calibration
+        if self.inputRanges != None:
+            self.inputRanges[name] = max(self.inputRanges.get(name, 0.0), float(np.max(np.abs(x))))
+        if self.precision == "int8" and name + "/inputScale" in self.weights:
+            scale = self.weights[name + "/inputScale"]
+            return np.clip(np.rint(x / scale), -127, 127) * scale
+        return x
+
+    def Kernel(self, name):
+        return self.kernels[name]
+
+    def Dense(self, x, name):
+        return np.dot(self.Input(x, name), self.Kernel(name)) + self.weights[name + "/bias"]
+
+    def Conv(self, x, name):
+        return Conv2DSame(self.Input(x, name), self.Kernel(name), self.weights[name + "/bias"])
+
+    def predict(self, XArray):
+        x = np.asarray(XArray, dtype=np.float32)
+        pool1 = MaxPoolValid(Selu(Conv2DSame(x, self.Kernel("conv1"), self.weights["conv1/bias"])), self.pollSize1)
+        pool2 = MaxPoolValid(Selu(self.Conv(pool1, "conv2")), self.pollSize2)
+        pool3 = MaxPoolValid(Selu(self.Conv(pool2, "conv3")), self.pollSize3)
+        fc4 = Selu(self.Dense(pool3.reshape(len(x), -1), "fc4"))
+        fc5 = Selu(self.Dense(fc4, "fc5"))
+        base = Sigmoid(self.Dense(fc4, "YBaseChangeSigmoid"))
+        zygosity = Softmax(Selu(self.Dense(fc5, "YZygosityFC")) + epsilon)
+        varType = Softmax(Selu(self.Dense(fc5, "YVarTypeFC")) + epsilon)
+        indelLength = Softmax(Selu(self.Dense(fc5, "YIndelLengthFC")) + epsilon)
+        return base, zygosity, varType, indelLength
+
+    def predictNoRT(self, XArray):
+        self.predictBaseRTVal = None; self.predictZygosityRTVal = None; self.predictVarTypeRTVal = None; self.predictIndelLengthRTVal = None
+        self.predictBaseRTVal, self.predictZygosityRTVal, self.predictVarTypeRTVal, self.predictIndelLengthRTVal = self.predict(XArray)
+
+
+def Compare(args, m):
+    # Largest difference between the predictions of tensorflow and of NumPy on random tensors
+    import clairvoyante_v3 as cv
+    tfm = cv.Clairvoyante()
+    tfm.init()
+    tfm.restoreParameters(os.path.abspath(args.chkpnt_fn))
+    X = np.random.RandomState(0).poisson(10, size=(1000,) + tfm.inputShape).astype(np.float32)
+    for i in range(1, X.shape[3]): X[:,:,:,i] -= X[:,:,:,0]
+    for name, a, b in zip(("base", "zygosity", "varType", "indelLength"), tfm.predict(X), m.predict(X)):
+        print >> sys.stderr, "%s: max absolute difference %g" % (name, np.max(np.abs(a - b)))
+
+
+def LoadTensors(tensor_fn, num):
+    # The first num tensors of a tensor file
+    import utils_v2 as utils
+    XArrays = []; total = 0
+    for end, n, XBatch, posBatch in utils.GetTensor(tensor_fn, param.predictBatchSize):
+        XArrays.append(XBatch[:num-total]); total += len(XArrays[-1])
+        if total >= num:
+            break
+    return np.concatenate(XArrays)
+
+
+def Report(args, m, q):
+    # How often the calls and the validation decisions of the reduced precision model q differ from the model m
+    from cStringIO import StringIO
+    import utils_v2 as utils
+    import clairvoyante_test as vv
+    import validateVar as vld
+    calls = []
+    for m_ in (m, q):
+        call_fh = StringIO()
+        for end, num, XBatch, posBatch in utils.GetTensor(args.tensor_fn, param.predictBatchSize):
+            if num == 0:
+                continue
+            base, z, t, l = m_.predict(XBatch)
+            vv.Output(args, call_fh, num, XBatch, posBatch, base, z, t, l)
+        calls.append(call_fh.getvalue().splitlines(True))
+    numDiff = sum(1 for a, b in zip(*calls) if vld.ProcessVCFRecord(a.split())[3] != vld.ProcessVCFRecord(b.split())[3])
+    print >> sys.stderr, "%s: %d of %d calls differ from float32" % (q.precision, numDiff, len(calls[0]))
+    if args.vcf_fn == None:
+        return
+
+    # Validate the calls of each contig against the input VCF with both models, and count the M/X decision changes
+    inputs = {}
+    vcf_fh = BGZF.OpenInput(args.vcf_fn)
+    for row in vcf_fh:
+        if row[0] != "#":
+            inputs.setdefault(row.split(None, 1)[0], []).append(row)
+    vcf_fh.close()
+    decisions = []
+    for c in calls:
+        outputs = {}
+        for row in c:
+            outputs.setdefault(row.split(None, 1)[0], []).append(row)
+        val_fh = StringIO()
+        for ctgName in sorted(outputs.keys()):
+            vld.ValidateShard(inputs.get(ctgName, []), outputs[ctgName], val_fh)
+        decisions.append([row.split("\t", 1)[0] for row in val_fh.getvalue().splitlines()])
+    numMX = sum(1 for a, b in zip(*decisions) if a in "MX")
+    numMtoX = sum(1 for a, b in zip(*decisions) if a == "M" and b == "X")
+    numXtoM = sum(1 for a, b in zip(*decisions) if a == "X" and b == "M")
+    print >> sys.stderr, "%s: %d of %d M/X decisions differ from float32 (%.4f%%), M to X: %d, X to M: %d" %\
+        (q.precision, numMtoX + numXtoM, numMX, 100.0 * (numMtoX + numXtoM) / numMX if numMX > 0 else 0.0, numMtoX, numXtoM)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            description="Export the weights of a Clairvoyante model for the NumPy inference engine" )
+
+    parser.add_argument('--chkpnt_fn', type=str, default = None,
+            help="Input a Clairvoyante model checkpoint, or float32 weights exported before")
+
+    parser.add_argument('--npz_fn', type=str, default = None,
+            help="Output the weights, use it as --chkpnt_fn to validate with NumPy, default: the checkpoint name with a .npz suffix, or .int8.npz and .float16.npz")
+
+    parser.add_argument('--precision', type=str, default = "float32", choices = precisions,
+            help="Precision of the exported weights, int8 needs --tensor_fn for calibration, default: %(default)s")
+
+    parser.add_argument('--tensor_fn', type=str, default = None,
+            help="Sample tensors from CreateTensorSites.py, to calibrate int8 and to report the calls differing from float32")
+
+    parser.add_argument('--calibrationSize', type=int, default = 20000,
+            help="Number of tensors used for int8 calibration, default: %(default)s")
+
+    parser.add_argument('--vcf_fn', type=str, default = None,
+            help="The VCF of the sites in --tensor_fn, to report the M/X validation decisions differing from float32, optional")
+
+    parser.add_argument('--compare', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Compare the predictions of tensorflow and NumPy on random tensors, default: %(default)s")
+
+    args = parser.parse_args()
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.precision == "int8" and args.tensor_fn == None:
+        sys.exit("Please provide sample tensors with --tensor_fn to calibrate int8")
+
+    m = Clairvoyante()
+    m.restoreParameters(args.chkpnt_fn)
+    if m.precision != "float32":
+        sys.exit("%s is already in %s" % (args.chkpnt_fn, m.precision))
+    if args.compare == True:
+        Compare(args, m)
+    q = m if args.precision == "float32" else m.quantize(args.precision, LoadTensors(args.tensor_fn, args.calibrationSize) if args.precision == "int8" else None)
+    npz_fn = args.npz_fn
+    if npz_fn == None:
+        npz_fn = args.chkpnt_fn + ".npz" if args.precision == "float32" else "%s.%s.npz" % (args.chkpnt_fn, args.precision)
+    q.saveParameters(npz_fn)
+    if args.precision != "float32" and args.tensor_fn != None:
+        Report(args, m, q)
@@ -5,8 +5,9 @@ import argparse
 import param
 import logging
 import numpy as np
-from threading import Thread
-from math import log
+import Queue
+import multiprocessing
+from threading import Thread, BoundedSemaphore
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
 num2base = dict(zip((0, 1, 2, 3), "ACGT"))
@@ -17,20 +18,54 @@ v2Length2Name = dict(zip((0, 1, 2, 3, 4, 5), ('0', '1', '2', '3', '4', '4+')))
 maxVarLength = 5
 inferIndelLengthMinimumAF = 0.125
 
+def LoadModel(chkpnt_fn):
+    # create a Clairvoyante, weights exported to .npz by clairvoyante_np.py are run with NumPy without tensorflow,
+    # and a .pb exported by freezeModel.py is an inference-only graph
+    if chkpnt_fn.endswith(".npz"):
+        import clairvoyante_np as cv
+        m = cv.Clairvoyante()
+    elif chkpnt_fn.endswith(".pb"):
+        import clairvoyante_v3 as cv
+        m = cv.FrozenClairvoyante()
+    else:
+        import clairvoyante_v3 as cv
+        m = cv.Clairvoyante()
+    m.init()
+
+    m.restoreParameters(os.path.abspath(chkpnt_fn))
+    return m
+
+
+class ModelPool(object):
+    # Models loaded once and shared by all tensor streams, a stream borrows an idle model for each batch
+    def __init__(self, chkpnt_fn, numModels):
+        self.numModels = numModels
+        self.models = Queue.Queue()
+        for i in range(numModels):
+            self.models.put(LoadModel(chkpnt_fn))
+
+    def predict(self, XArray):
+        m = self.models.get()
+        try:
+            return m.predict(XArray)
+        finally:
+            self.models.put(m)
+
+
 def Run(args):
-    # create a Clairvoyante
     import utils_v2 as utils
-    import clairvoyante_v3 as cv
     utils.SetupEnv()
     if args.threads == None:
         if args.tensor_fn == "PIPE":
             param.NUM_THREADS = 1
     else:
         param.NUM_THREADS = args.threads
-    m = cv.Clairvoyante()
-    m.init()
-
-    m.restoreParameters(os.path.abspath(args.chkpnt_fn))
+    if args.inferenceWorkers > 1:
+        # Split the threads evenly among the models of the inference workers
+        param.NUM_THREADS = param.NUM_THREADS / args.inferenceWorkers if param.NUM_THREADS >= args.inferenceWorkers else 1
+        m = ModelPool(args.chkpnt_fn, args.inferenceWorkers)
+    else:
+        m = LoadModel(args.chkpnt_fn)
     Test(args, m, utils)
 
 
@@ -42,92 +77,222 @@ def Output(args, call_fh, num, XBatch, posBatch, base, z, t, l):
     #          Base chng       Zygo.   Var type        Var length
     #          A   C   G   T   HET HOM REF SNP INS DEL 0   1   2   3   4   >=4
     #          0   1   2   3   4   5   6   7   8   9   10  11  12  13  14  15
-    for j in range(len(base)):
-        # Get variant type, 0:REF, 1:SNP, 2:INS, 3:DEL
-        varType = np.argmax(t[j])
-        # Get zygosity, 0:HET, 1:HOM
-        varZygosity = np.argmax(z[j])
-        # Get Indel Length, 0:0, 1:1, 2:2, 3:3, 4:4, 5:>4
-        varLength = np.argmax(l[j])
+    # The calls of the whole batch are computed on arrays, only the indels are inferred row by row
+    # Get variant type, 0:REF, 1:SNP, 2:INS, 3:DEL
+    varTypes = np.argmax(t, axis=1)
+    # Get zygosity, 0:HET, 1:HOM
+    varZygosities = np.argmax(z, axis=1)
+    # Get Indel Length, 0:0, 1:1, 2:2, 3:3, 4:4, 5:>4
+    varLengths = np.argmax(l, axis=1)
+    # Get genotype quality from the ratio of the second best to the best probabilities
+    sortVarType = np.sort(t, axis=1); sortZygosity = np.sort(z, axis=1); sortLength = np.sort(l, axis=1)
+    second = (sortVarType[:,-2]*sortZygosity[:,-2]*sortLength[:,-2]).astype(np.float64)
+    first = (sortVarType[:,-1]*sortZygosity[:,-1]*sortLength[:,-1]).astype(np.float64)
+    quals = (-4.343 * np.log((second + 1e-300) / (first + 1e-300))).astype(int)
+    #quals = np.minimum(quals, 999)
+    # Get possible alternative bases
+    sortBase = base.argsort(axis=1)[:,::-1]
+    # Depth of SNP and REF, and of insertions and deletions
+    XCenter = XBatch[:num,param.flankingBaseNum]; XNext = XBatch[:num,param.flankingBaseNum+1]
+    dps = np.where(varTypes <= 1, np.sum(XCenter[:,:,0] + XCenter[:,:,3], axis=1),
+                   np.where(varTypes == 2, np.sum(XNext[:,:,0] + XNext[:,:,1], axis=1), np.sum(XNext[:,:,0] + XNext[:,:,2], axis=1)))
+
+    lines = []
+    for j in range(num):
+        varType = varTypes[j]; varLength = varLengths[j]
         # Get chromosome, coordination and reference bases with flanking param.flankingBaseNum flanking bases at coordination
         chromosome, coordination, refSeq = posBatch[j].split(":")
-        # Get genotype quality
-        sortVarType = np.sort(t[j])[::-1]
-        sortZygosity = np.sort(z[j])[::-1]
-        sortLength = np.sort(l[j])[::-1]
-        qual = int(-4.343 * log((sortVarType[1]*sortZygosity[1]*sortLength[1]  + 1e-300) / (sortVarType[0]*sortZygosity[0]*sortLength[0]  + 1e-300)))
-        #if qual > 999: qual = 999
-        # Get possible alternative bases
-        sortBase = base[j].argsort()[::-1]
-        base1 = num2base[sortBase[0]]
-        base2 = num2base[sortBase[1]]
+        coordination = int(coordination)
         # Initialize other variables
-        refBase = ""; altBase = ""; inferredIndelLength = 0; dp = 0; info = [];
-        # For SNP
-        if varType == 1 or varType == 0: # SNP or REF
-            coordination = int(coordination)
-            refBase = refSeq[param.flankingBaseNum]
-            if varType == 1: # SNP
-                altBase = base1 if base1 != refBase else base2
-                #altBase = "%s,%s" % (base1, base2)
-            elif varType == 0: # REF
-                altBase = refBase
-            dp = sum(XBatch[j,param.flankingBaseNum,:,0] + XBatch[j,param.flankingBaseNum,:,3])
-        elif varType == 2: # INS
-            # infer the insertion length
-            if varLength == 0: varLength = 1
-            dp = sum(XBatch[j,param.flankingBaseNum+1,:,0] + XBatch[j,param.flankingBaseNum+1,:,1])
-            if varLength != maxVarLength:
-                for k in range(param.flankingBaseNum+1, param.flankingBaseNum+varLength+1):
-                    altBase += num2base[np.argmax(XBatch[j,k,:,1])]
-            else:
-                for k in range(param.flankingBaseNum+1, 2*param.flankingBaseNum+1):
-                    referenceTensor = XBatch[j,k,:,0]; insertionTensor = XBatch[j,k,:,1]
-                    if k < (param.flankingBaseNum + maxVarLength) or sum(insertionTensor) >= (inferIndelLengthMinimumAF * sum(referenceTensor)):
-                        inferredIndelLength += 1
-                        altBase += num2base[np.argmax(insertionTensor)]
-                    else:
-                        break
-            coordination = int(coordination)
-            refBase = refSeq[param.flankingBaseNum]
-            # insertions longer than (param.flankingBaseNum-1) are marked SV
-            if inferredIndelLength >= param.flankingBaseNum:
-                altBase = "<INS>"
-                info.append("SVTYPE=INS")
-            else:
-                altBase = refBase + altBase
-        elif varType == 3: # DEL
-            if varLength == 0: varLength = 1
-            dp = sum(XBatch[j,param.flankingBaseNum+1,:,0] + XBatch[j,param.flankingBaseNum+1,:,2])
-            # infer the deletion length
-            if varLength == maxVarLength:
-                for k in range(param.flankingBaseNum+1, 2*param.flankingBaseNum+1):
-                    if k < (param.flankingBaseNum + maxVarLength) or sum(XBatch[j,k,:,2]) >= (inferIndelLengthMinimumAF * sum(XBatch[j,k,:,0])):
-                        inferredIndelLength += 1
-                    else:
-                        break
-            # deletions longer than (param.flankingBaseNum-1) are marked SV
-            coordination = int(coordination)
-            if inferredIndelLength >= param.flankingBaseNum:
-                refBase = refSeq[param.flankingBaseNum]
-                altBase = "<DEL>"
-                info.append("SVTYPE=DEL")
-            elif varLength != maxVarLength:
-                refBase = refSeq[param.flankingBaseNum:param.flankingBaseNum+varLength+1]
-                altBase = refSeq[param.flankingBaseNum]
-            else:
-                refBase = refSeq[param.flankingBaseNum:param.flankingBaseNum+inferredIndelLength+1]
-                altBase = refSeq[param.flankingBaseNum]
-        if inferredIndelLength > 0 and inferredIndelLength < param.flankingBaseNum: info.append("LENGUESS=%d" % inferredIndelLength)
-        infoStr = ""
-        if len(info) == 0: infoStr = "."
-        else: infoStr = ";".join(info)
-        gtStr = ""
+        refBase = refSeq[param.flankingBaseNum]; altBase = ""; inferredIndelLength = 0; infoStr = "."
+        if varType == 1: # SNP
+            base1 = num2base[sortBase[j,0]]
+            altBase = base1 if base1 != refBase else num2base[sortBase[j,1]]
+        elif varType == 0: # REF
+            altBase = refBase
+        else:
+            refBase, altBase, inferredIndelLength, info = InferIndel(XBatch[j], refSeq, varType, varLength)
+            if inferredIndelLength > 0 and inferredIndelLength < param.flankingBaseNum: info.append("LENGUESS=%d" % inferredIndelLength)
+            if len(info) != 0: infoStr = ";".join(info)
         if varType == 0: gtStr = "0/0"
-        elif varZygosity == 0: gtStr = "0/1"
-        elif varZygosity == 1: gtStr = "1/1"
+        elif varZygosities[j] == 0: gtStr = "0/1"
+        else: gtStr = "1/1"
 
-        print >> call_fh, "%s\t%d\t.\t%s\t%s\t%d\t.\t%s\tGT:GQ:DP\t%s:%d:%d" % (chromosome, coordination, refBase, altBase, qual, infoStr, gtStr, qual, dp)
+        lines.append("%s\t%d\t.\t%s\t%s\t%d\t.\t%s\tGT:GQ:DP\t%s:%d:%d\n" % (chromosome, coordination, refBase, altBase, quals[j], infoStr, gtStr, quals[j], dps[j]))
+    call_fh.write("".join(lines))
+
+
+def InferIndel(X, refSeq, varType, varLength):
+    # The reference and alternative alleles of an insertion (varType 2) or a deletion (varType 3), the inferred
+    # length of the indels longer than maxVarLength - 1, and the INFO entries
+    refBase = ""; altBase = ""; inferredIndelLength = 0; info = []
+    if varLength == 0: varLength = 1
+    if varType == 2: # INS
+        # infer the insertion length
+        if varLength != maxVarLength:
+            for k in range(param.flankingBaseNum+1, param.flankingBaseNum+varLength+1):
+                altBase += num2base[np.argmax(X[k,:,1])]
+        else:
+            for k in range(param.flankingBaseNum+1, 2*param.flankingBaseNum+1):
+                referenceTensor = X[k,:,0]; insertionTensor = X[k,:,1]
+                if k < (param.flankingBaseNum + maxVarLength) or sum(insertionTensor) >= (inferIndelLengthMinimumAF * sum(referenceTensor)):
+                    inferredIndelLength += 1
+                    altBase += num2base[np.argmax(insertionTensor)]
+                else:
+                    break
+        refBase = refSeq[param.flankingBaseNum]
+        # insertions longer than (param.flankingBaseNum-1) are marked SV
+        if inferredIndelLength >= param.flankingBaseNum:
+            altBase = "<INS>"
+            info.append("SVTYPE=INS")
+        else:
+            altBase = refBase + altBase
+    else: # DEL
+        # infer the deletion length
+        if varLength == maxVarLength:
+            for k in range(param.flankingBaseNum+1, 2*param.flankingBaseNum+1):
+                if k < (param.flankingBaseNum + maxVarLength) or sum(X[k,:,2]) >= (inferIndelLengthMinimumAF * sum(X[k,:,0])):
+                    inferredIndelLength += 1
+                else:
+                    break
+        # deletions longer than (param.flankingBaseNum-1) are marked SV
+        if inferredIndelLength >= param.flankingBaseNum:
+            refBase = refSeq[param.flankingBaseNum]
+            altBase = "<DEL>"
+            info.append("SVTYPE=DEL")
+        elif varLength != maxVarLength:
+            refBase = refSeq[param.flankingBaseNum:param.flankingBaseNum+varLength+1]
+            altBase = refSeq[param.flankingBaseNum]
+        else:
+            refBase = refSeq[param.flankingBaseNum:param.flankingBaseNum+inferredIndelLength+1]
+            altBase = refSeq[param.flankingBaseNum]
+    return refBase, altBase, inferredIndelLength, info
+
+
+def TestBatch(args, pools, batches, call_fhs):
+    # Validate the tensor batches with a list of ModelPools, one for each model of an ensemble, the calls of each model
+    # are output to the matching call_fhs
+    for end, num, XBatch, posBatch in batches:
+        if num == 0:
+            continue
+        for pool, call_fh in zip(pools, call_fhs):
+            base, z, t, l = pool.predict(XBatch)
+            Output(args, call_fh, num, XBatch, posBatch, base, z, t, l)
+
+
+def TestStream(args, pools, utils, tensor_fh, call_fhs, queueSize = 2):
+    # The tensors of a stream through the staged pipeline of Test, with as many inference workers as models in a pool
+    numWorkers = pools[0].numModels
+    batches = utils.GetTensor( None, param.predictBatchSize, tensor_fh, numBuffers = MaxInFlight(numWorkers, queueSize) )
+    TestPipeline(args, pools, batches, call_fhs, numWorkers, queueSize)
+
+
+def ParseTensors(tensor_fn, tensor_fd, num, queue):
+    # The reader stage in its own process, the batches are sent pickled through queue, None at the end or an error
+    # message
+    import utils_v2 as utils
+    try:
+        tensor_fh = os.fdopen(tensor_fd, "rb") if tensor_fd != None else None
+        for batch in utils.GetTensor(tensor_fn, num, tensor_fh):
+            queue.put(batch)
+        queue.put(None)
+    except Exception as e:
+        queue.put("Failed to read the tensors: %s" % (e))
+
+
+def ParsedBatches(tensor_fn, num, queueSize):
+    # The batches parsed by ParseTensors in a child process, at most queueSize of them are parsed ahead
+    tensor_fd = os.dup(sys.stdin.fileno()) if tensor_fn == "PIPE" else None
+    queue = multiprocessing.Queue(queueSize)
+    p = multiprocessing.Process(target=ParseTensors, args=(tensor_fn, tensor_fd, num, queue))
+    p.daemon = True
+    p.start()
+    if tensor_fd != None:
+        os.close(tensor_fd)
+    while True:
+        try:
+            batch = queue.get(True, 1)
+        except Queue.Empty:
+            if not p.is_alive():
+                raise RuntimeError("The tensor reader exited with code %s" % (p.exitcode))
+            continue
+        if batch == None:
+            break
+        if isinstance(batch, str):
+            raise RuntimeError(batch)
+        yield batch
+    p.join()
+
+
+def MaxInFlight(numWorkers, queueSize):
+    # The batches read and not yet written by TestPipeline, a ring of as many buffers is never overwritten too early
+    return 2 * queueSize + numWorkers
+
+
+def TestPipeline(args, pools, batches, call_fhs, numWorkers, queueSize):
+    # A staged pipeline: a reader takes the tensor batches, inference workers predict them with each model of pools and
+    # this thread writes the calls of each model to the matching call_fhs in the input order. The stages are joined by
+    # bounded queues, and at most MaxInFlight batches are read and not yet written, the reader waits for the writer
+    # beyond it
+    inFlight = BoundedSemaphore(MaxInFlight(numWorkers, queueSize))
+    tensorQueue = Queue.Queue(queueSize)
+    resultQueue = Queue.Queue(queueSize)
+    failed = []
+
+    def Read():
+        try:
+            i = 0
+            while len(failed) == 0:
+                inFlight.acquire()
+                batch = next(batches, None)
+                if batch == None:
+                    break
+                tensorQueue.put((i, batch))
+                i += 1
+        except Exception as e:
+            failed.append(e)
+        finally:
+            for w in range(numWorkers):
+                tensorQueue.put(None)
+
+    def Predict():
+        # After a failure, the batches are passed on without prediction so that the pipeline drains
+        while True:
+            item = tensorQueue.get()
+            if item == None:
+                break
+            i, (end, num, XBatch, posBatch) = item
+            predictions = None
+            if num != 0 and len(failed) == 0:
+                try:
+                    predictions = [pool.predict(XBatch) for pool in pools]
+                except Exception as e:
+                    failed.append(e)
+            resultQueue.put((i, num, XBatch, posBatch, predictions))
+        resultQueue.put(None)
+
+    stages = [Thread(target=Read)] + [Thread(target=Predict) for w in range(numWorkers)]
+    for t in stages:
+        t.daemon = True
+        t.start()
+
+    pending = {}; nextIndex = 0; numDone = 0
+    while numDone < numWorkers:
+        item = resultQueue.get()
+        if item == None:
+            numDone += 1
+            continue
+        pending[item[0]] = item[1:]
+        while nextIndex in pending:
+            num, XBatch, posBatch, predictions = pending.pop(nextIndex)
+            nextIndex += 1
+            if predictions != None and len(failed) == 0:
+                for (base, z, t, l), call_fh in zip(predictions, call_fhs):
+                    Output(args, call_fh, num, XBatch, posBatch, base, z, t, l)
+            inFlight.release()
+    for t in stages: t.join()
+    if len(failed) != 0:
+        raise failed[0]
 
 
 def Test(args, m, utils):
@@ -135,37 +300,21 @@ def Test(args, m, utils):
         call_fh = open(args.call_fn, "w")
     else:
         call_fh = sys.stdout
-    tensorGenerator = utils.GetTensor( args.tensor_fn, param.predictBatchSize )
+    numWorkers = args.inferenceWorkers if args.inferenceWorkers > 1 else 1
+    queueSize = args.queueSize if args.queueSize > 1 else 1
+    if args.parseProcess == True:
+        batches = ParsedBatches(args.tensor_fn, param.predictBatchSize, queueSize)
+    else:
+        # A batch buffer is reused only after it is written
+        batches = utils.GetTensor( args.tensor_fn, param.predictBatchSize, numBuffers = MaxInFlight(numWorkers, queueSize) )
+
     #logging.info("Validating variants ...")
     predictStart = time.time()
-    end = 0; end2 = 0; terminate = 0
-    end2, num2, XBatch2, posBatch2 = next(tensorGenerator)
-    m.predictNoRT(XBatch2)
-    base = m.predictBaseRTVal; z = m.predictZygosityRTVal; t = m.predictVarTypeRTVal; l = m.predictIndelLengthRTVal
-    if end2 == 0:
-        end = end2; num = num2; XBatch = XBatch2; posBatch = posBatch2
-        end2, num2, XBatch2, posBatch2 = next(tensorGenerator)
-        while True:
-            if end == 1:
-                terminate = 1
-            threadPool = []
-            if end == 0:
-                threadPool.append(Thread(target=m.predictNoRT, args=(XBatch2, )))
-            threadPool.append(Thread(target=Output, args=(args, call_fh, num, XBatch, posBatch, base, z, t, l, )))
-            for t in threadPool: t.start()
-            if end2 == 0:
-                end3, num3, XBatch3, posBatch3 = next(tensorGenerator)
-            for t in threadPool: t.join()
-            base = m.predictBaseRTVal; z = m.predictZygosityRTVal; t = m.predictVarTypeRTVal; l = m.predictIndelLengthRTVal
-            if end == 0:
-                end = end2; num = num2; XBatch = XBatch2; posBatch = posBatch2
-            if end2 == 0:
-                end2 = end3; num2 = num3; XBatch2 = XBatch3; posBatch2 = posBatch3
-            #print >> sys.stderr, end, end2, end3, terminate
-            if terminate == 1:
-                break
-    elif end2 == 1:
-        Output(args, call_fh, num2, XBatch2, posBatch2, base, z, t, l)
+    try:
+        TestPipeline(args, [m], batches, [call_fh], numWorkers, queueSize)
+    finally:
+        if call_fh != sys.stdout:
+            call_fh.close()
 
     #logging.info("Total time elapsed: %.2f s" % (time.time() - predictStart))
 
@@ -179,7 +328,7 @@ if __name__ == "__main__":
             help="Input tensors, use PIPE for standard input")
 
     parser.add_argument('--chkpnt_fn', type=str, default = None,
-            help="Input a Clairvoyante model")
+            help="Input a Clairvoyante model, its weights exported to .npz by clairvoyante_np.py or its graph exported to .pb by freezeModel.py")
 
     parser.add_argument('--call_fn', type=str, default = "PIPE",
             help="Output validation results")
@@ -190,6 +339,15 @@ if __name__ == "__main__":
     parser.add_argument('--threads', type=int, default = None,
             help="Number of threads, optional")
 
+    parser.add_argument('--inferenceWorkers', type=int, default = 1,
+            help="Number of models predicting batches concurrently, the threads are divided among them, default: %(default)s")
+
+    parser.add_argument('--queueSize', type=int, default = 2,
+            help="Number of batches queued between the reader, the inference workers and the writer, default: %(default)s")
+
+    parser.add_argument('--parseProcess', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Parse the tensors in a separate process, default: %(default)s")
+
     args = parser.parse_args()
 
     if len(sys.argv[1:]) == 0:
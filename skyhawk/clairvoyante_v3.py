@@ -2,6 +2,9 @@ import tensorflow as tf
 import selu
 import param
 
+# The output nodes of the inference graph, the sigmoid of YBaseChangeSigmoid is named after its dense layer
+inferenceOutputs = ['YBaseChangeSigmoid/Sigmoid', 'YZygositySoftmax', 'YVarTypeSoftmax', 'YIndelLengthSoftmax']
+
 class Clairvoyante(object):
 
     def __init__(self, inputShape = (2*param.flankingBaseNum+1, 4, param.matrixNum),
@@ -26,7 +29,7 @@ class Clairvoyante(object):
         self.predictBaseRTVal = None; self.predictZygosityRTVal = None; self.predictVarTypeRTVal = None; self.predictIndelLengthRTVal = None
         self.g = tf.Graph()
         self._buildGraph()
-        self.session = tf.Session(graph = self.g, config=tf.ConfigProto(intra_op_parallelism_threads=param.NUM_THREADS))
+        self.session = tf.Session(graph = self.g, config=tf.ConfigProto(intra_op_parallelism_threads=param.NUM_THREADS, inter_op_parallelism_threads=param.NUM_INTER_THREADS))
 
     def _buildGraph(self):
         with self.g.as_default():
@@ -250,6 +253,38 @@ class Clairvoyante(object):
             self.saver = tf.train.Saver()
             self.saver.restore(self.session, fn)
 
+    def exportInferenceGraph(self, fn):
+        # Rebuild the network without the training placeholders, the dropout and the loss, with the trained weights
+        # frozen into constants, and write the graph with its constants folded to fn
+        with self.g.as_default():
+            weights = self.session.run(dict((v.op.name, v) for v in tf.trainable_variables()))
+        g = tf.Graph()
+        with g.as_default():
+            def Init(name):
+                return dict(kernel_initializer=tf.constant_initializer(weights[name + "/kernel"]), bias_initializer=tf.constant_initializer(weights[name + "/bias"]), name=name)
+            XPH = tf.placeholder(tf.float32, [None, self.inputShape[0], self.inputShape[1], self.inputShape[2]], name='XPH')
+            conv1 = tf.layers.conv2d(XPH, self.numFeature1, self.kernelSize1, padding="same", activation=selu.selu, **Init('conv1'))
+            pool1 = tf.layers.max_pooling2d(conv1, self.pollSize1, strides=1, name='pool1')
+            conv2 = tf.layers.conv2d(pool1, self.numFeature2, self.kernelSize2, padding="same", activation=selu.selu, **Init('conv2'))
+            pool2 = tf.layers.max_pooling2d(conv2, self.pollSize2, strides=1, name='pool2')
+            conv3 = tf.layers.conv2d(pool2, self.numFeature3, self.kernelSize3, padding="same", activation=selu.selu, **Init('conv3'))
+            pool3 = tf.layers.max_pooling2d(conv3, self.pollSize3, strides=1, name='pool3')
+            conv3_flat = tf.reshape(pool3, [-1, int(weights['fc4/kernel'].shape[0])])
+            fc4 = tf.layers.dense(conv3_flat, self.hiddenLayerUnits4, activation=selu.selu, **Init('fc4'))
+            fc5 = tf.layers.dense(fc4, self.hiddenLayerUnits5, activation=selu.selu, **Init('fc5'))
+            epsilon = tf.constant(value=1e-10)
+            tf.layers.dense(fc4, self.outputShape1[0], activation=tf.nn.sigmoid, **Init('YBaseChangeSigmoid'))
+            tf.nn.softmax(tf.layers.dense(fc5, self.outputShape2[0], activation=selu.selu, **Init('YZygosityFC')) + epsilon, name='YZygositySoftmax')
+            tf.nn.softmax(tf.layers.dense(fc5, self.outputShape3[0], activation=selu.selu, **Init('YVarTypeFC')) + epsilon, name='YVarTypeSoftmax')
+            tf.nn.softmax(tf.layers.dense(fc5, self.outputShape4[0], activation=selu.selu, **Init('YIndelLengthFC')) + epsilon, name='YIndelLengthSoftmax')
+            with tf.Session(graph = g) as session:
+                session.run(tf.global_variables_initializer())
+                graphDef = tf.graph_util.convert_variables_to_constants(session, g.as_graph_def(), inferenceOutputs)
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graphDef = TransformGraph(graphDef, ['XPH'], inferenceOutputs, ['strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+        with tf.gfile.GFile(fn, "wb") as f:
+            f.write(graphDef.SerializeToString())
+
     def summaryFileWriter(self, logsPath):
         summaryWriter = tf.summary.FileWriter(logsPath, graph=self.g)
         return summaryWriter
@@ -282,3 +317,38 @@ class Clairvoyante(object):
     def __del__(self):
         self.session.close()
 
+
+class FrozenClairvoyante(object):
+    # A Clairvoyante loaded from a graph written by exportInferenceGraph, only the input tensors are fed
+
+    def __init__(self):
+        self.predictBaseRTVal = None; self.predictZygosityRTVal = None; self.predictVarTypeRTVal = None; self.predictIndelLengthRTVal = None
+        self.g = tf.Graph()
+        self.session = tf.Session(graph = self.g, config=tf.ConfigProto(intra_op_parallelism_threads=param.NUM_THREADS, inter_op_parallelism_threads=param.NUM_INTER_THREADS))
+
+    def init(self):
+        pass
+
+    def close(self):
+        self.session.close()
+
+    def restoreParameters(self, fn):
+        graphDef = tf.GraphDef()
+        with tf.gfile.GFile(fn, "rb") as f:
+            graphDef.ParseFromString(f.read())
+        with self.g.as_default():
+            tf.import_graph_def(graphDef, name='')
+        self.XPH = self.g.get_tensor_by_name('XPH:0')
+        self.outputs = tuple(self.g.get_tensor_by_name(name + ':0') for name in inferenceOutputs)
+
+    def predict(self, XArray):
+        base, zygosity, varType, indelLength = self.session.run( self.outputs, feed_dict={self.XPH:XArray} )
+        return base, zygosity, varType, indelLength
+
+    def predictNoRT(self, XArray):
+        self.predictBaseRTVal = None; self.predictZygosityRTVal = None; self.predictVarTypeRTVal = None; self.predictIndelLengthRTVal = None
+        self.predictBaseRTVal, self.predictZygosityRTVal, self.predictVarTypeRTVal, self.predictIndelLengthRTVal \
+                                             = self.session.run( self.outputs, feed_dict={self.XPH:XArray} )
+
+    def __del__(self):
+        self.session.close()
@@ -0,0 +1,33 @@
+import sys
+import os
+import argparse
+
+def Run(args):
+    import utils_v2 as utils
+    utils.SetupEnv()
+    import clairvoyante_v3 as cv
+    m = cv.Clairvoyante()
+    m.init()
+    m.restoreParameters(os.path.abspath(args.chkpnt_fn))
+    m.exportInferenceGraph(args.pb_fn if args.pb_fn != None else args.chkpnt_fn + ".pb")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+            description="Export an inference-only graph of a Clairvoyante model, with the weights frozen into constants" )
+
+    parser.add_argument('--chkpnt_fn', type=str, default = None,
+            help="Input a Clairvoyante model checkpoint")
+
+    parser.add_argument('--pb_fn', type=str, default = None,
+            help="Output the frozen graph, use it as --chkpnt_fn to validate, default: the checkpoint name with a .pb suffix")
+
+    args = parser.parse_args()
+
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    Run(args)
+
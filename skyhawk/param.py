@@ -1,9 +1,18 @@
 NUM_THREADS = 2
+NUM_INTER_THREADS = 0       # 0 to let tensorflow decide
 
 # Tensor related parameters, please use the same values for creating tensor, model training and variant calling
 flankingBaseNum = 16        # Please change this value in the dataPrepScripts at the same time
 matrixNum = 4               # Please change this value in the dataPrepScripts at the same time
 bloscBlockSize = 500
+expandReferenceRegion = 1000000 # Please change this value in the dataPrepScripts at the same time
+expandReadsRegion = 300         # Please change this value in the dataPrepScripts at the same time
+tensorMagic = "SKYTNS01"        # Please change this value in the dataPrepScripts at the same time
+tensorBlockHeader = "<IBBHI"    # Please change this value in the dataPrepScripts at the same time
+tensorBlockSize = 2000          # Please change this value in the dataPrepScripts at the same time
+
+# Validation parameters
+shardSize = 50000
 
 # Model hyperparameters
 predictBatchSize = 2000
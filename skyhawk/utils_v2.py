@@ -2,14 +2,16 @@ import os
 home_dir = os.path.expanduser('~')
 import sys
 sys.path.append(home_dir+'/miniconda2/lib/python2.7/site-packages')
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../dataPrepScripts")
 import intervaltree
 import numpy as np
 import random
 import param
 import blosc
 import gc
-import shlex
-import subprocess
+import struct
+import itertools
+import BGZF
 
 base2num = dict(zip("ACGT",(0, 1, 2, 3)))
 
@@ -22,49 +24,178 @@ def SetupEnv():
 def UnpackATensorRecord(a, b, c, *d):
     return a, b, c, np.array(d, dtype=np.float32)
 
-def GetTensor( tensor_fn, num ):
-    if tensor_fn != "PIPE":
-        f = subprocess.Popen(shlex.split("gzip -fdc %s" % (tensor_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
-        fo = f.stdout
+def GetTensorRecord( tensor_fn, tensor_fh = None ):
+    if tensor_fh != None:
+        fo = tensor_fh
+    elif tensor_fn != "PIPE":
+        fo = BGZF.OpenInput(tensor_fn)
     else:
         fo = sys.stdin
-    total = 0
-    c = 0
-    rows = np.empty((num, ((2*param.flankingBaseNum+1)*4*param.matrixNum)), dtype=np.float32)
-    pos = []
     for row in fo: # A variant per row
         try:
-            chrom, coord, seq, rows[c] = UnpackATensorRecord(*(row.split()))
+            record = UnpackATensorRecord(*(row.split()))
         except ValueError:
             print >> sys.stderr, "UnpackATensorRecord Failure", row
-        if seq[param.flankingBaseNum] not in ["A","C","G","T"]: # TODO: Support IUPAC in the future
             continue
-        pos.append(chrom + ":" + coord + ":" + seq)
-        c += 1
-
-        if c == num:
-            x = np.reshape(rows, (num,2*param.flankingBaseNum+1,4,param.matrixNum))
-            for i in range(1, param.matrixNum): x[:,:,:,i] -= x[:,:,:,0]
-            total += c; print >> sys.stderr, "Processed %d tensors" % total
-            yield 0, c, x, pos
-            c = 0
-            rows = np.empty((num, ((2*param.flankingBaseNum+1)*4*param.matrixNum)), dtype=np.float32)
-            pos = []
-
-    if tensor_fn != "PIPE":
+        yield record
+
+    if tensor_fh == None and tensor_fn != "PIPE":
         fo.close()
-        f.wait()
-    x = np.reshape(rows[:c], (c,2*param.flankingBaseNum+1,4,param.matrixNum))
-    for i in range(1, param.matrixNum): x[:,:,:,i] -= x[:,:,:,0]
+
+class TensorBuffers(object):
+    # A ring of numBuffers preallocated batch arrays, a batch is overwritten numBuffers batches later. With no
+    # buffers, each batch is a new array
+    def __init__(self, num, numBuffers):
+        self.shape = (num, 2*param.flankingBaseNum+1, 4, param.matrixNum)
+        self.buffers = [np.empty(self.shape, dtype=np.float32) for i in range(numBuffers)]
+        self.i = 0
+
+    def Next(self):
+        if len(self.buffers) == 0:
+            return np.empty(self.shape, dtype=np.float32)
+        x = self.buffers[self.i]
+        self.i = (self.i + 1) % len(self.buffers)
+        return x
+
+def FillBatches( chunks, num, numBuffers = 0 ):
+    # Copy chunks of (positions, flattened tensors) into batches of num tensors, as (batch, 2*flankingBaseNum+1, 4,
+    # matrixNum) arrays with the channels 1 to matrixNum-1 relative to channel 0. A consumer must be done with a batch
+    # before taking numBuffers more
+    buffers = TensorBuffers(num, numBuffers)
+    total = 0
+    c = 0
+    x = buffers.Next(); rows = x.reshape(num, -1)
+    pos = []
+    for chunkPos, chunkRows in chunks:
+        i = 0
+        while i < len(chunkPos):
+            n = min(num - c, len(chunkPos) - i)
+            rows[c:c+n] = chunkRows[i:i+n]
+            pos.extend(chunkPos[i:i+n])
+            c += n; i += n
+
+            if c == num:
+                for k in range(1, param.matrixNum): x[:,:,:,k] -= x[:,:,:,0]
+                total += c; print >> sys.stderr, "Processed %d tensors" % total
+                yield 0, c, x, pos
+                c = 0
+                x = buffers.Next(); rows = x.reshape(num, -1)
+                pos = []
+
+    x = x[:c]
+    for k in range(1, param.matrixNum): x[:,:,:,k] -= x[:,:,:,0]
     total += c; print >> sys.stderr, "Processed %d tensors" % total
     yield 1, c, x, pos
 
+def BatchTensor( records, num, numBuffers = 0 ):
+    # Batch (chrom, coord, seq, flattened tensor) records into (batch, 2*flankingBaseNum+1, 4, matrixNum) arrays
+    def Chunks():
+        for chrom, coord, seq, mat in records:
+            if seq[param.flankingBaseNum] not in ["A","C","G","T"]: # TODO: Support IUPAC in the future
+                continue
+            yield [chrom + ":" + coord + ":" + seq], np.asarray(mat).reshape(1, -1)
+    return FillBatches( Chunks(), num, numBuffers )
+
+def ParseTensorLines( lines ):
+    # The positions and the flattened tensors of text tensor lines, the counts of all lines parsed in one call
+    tensorSize = (2*param.flankingBaseNum+1)*4*param.matrixNum
+    rows = []
+    for row in lines:
+        row = row.split(None, 3)
+        if len(row) != 4:
+            print >> sys.stderr, "UnpackATensorRecord Failure", " ".join(row)
+            continue
+        if row[2][param.flankingBaseNum] not in "ACGT": # TODO: Support IUPAC in the future
+            continue
+        rows.append(row)
+    text = " ".join([row[3] for row in rows]) + " "
+    # The counts are integers written as "%0.1f", parsed faster as integers without their ".0". Other decimals stop
+    # the parsing early, then the counts are parsed as floats
+    counts = np.fromstring(text.replace(".0 ", " ").replace(".0\n", "\n"), dtype=np.int32, sep=" ")
+    if len(counts) != len(rows) * tensorSize:
+        counts = np.fromstring(text, dtype=np.float32, sep=" ")
+    if len(counts) != len(rows) * tensorSize:
+        # A malformed line, parse line by line to skip it
+        parsed = []
+        for row in rows:
+            mat = np.fromstring(row[3], dtype=np.float32, sep=" ")
+            if len(mat) != tensorSize:
+                print >> sys.stderr, "UnpackATensorRecord Failure", " ".join(row)
+                continue
+            parsed.append((row, mat))
+        rows = [row for row, mat in parsed]
+        counts = np.array([mat for row, mat in parsed], dtype=np.float32)
+    return [row[0] + ":" + row[1] + ":" + row[2] for row in rows], counts.reshape(-1, tensorSize)
+
+def BatchTextTensor( fo, num, numBuffers = 0, closeAfter = False ):
+    # Same batches as BatchTensor, the lines of a whole batch are parsed at once
+    def Chunks():
+        while True:
+            lines = list(itertools.islice(fo, num))
+            if len(lines) == 0:
+                break
+            yield ParseTensorLines(lines)
+        if closeAfter == True:
+            fo.close()
+    return FillBatches( Chunks(), num, numBuffers )
+
+def GetBinaryTensorBlock( fo ):
+    # Yield the chromosome and the records of each block written by CreateTensorSites --tensorFormat binary
+    headerSize = struct.calcsize(param.tensorBlockHeader)
+    windowLen = 2*param.flankingBaseNum+1
+    tensorSize = windowLen*4*param.matrixNum
+    while True:
+        header = fo.read(headerSize)
+        if len(header) == 0:
+            break
+        if len(header) != headerSize:
+            print >> sys.stderr, "Truncated binary tensor block"
+            break
+        num, width, compressed, chromLen, payloadLen = struct.unpack(param.tensorBlockHeader, header)
+        chrom = fo.read(chromLen)
+        payload = fo.read(payloadLen)
+        if compressed:
+            payload = blosc.decompress(payload)
+        recordType = np.dtype([("pos", "<u4"), ("seq", "S%d" % windowLen), ("counts", "<u%d" % width, (tensorSize,))])
+        yield chrom, np.frombuffer(payload, dtype=recordType, count=num)
+
+def BatchBinaryTensor( fo, num, numBuffers = 0 ):
+    # Same batches as BatchTensor, the counts of a block are copied into the batch arrays at once
+    windowLen = 2*param.flankingBaseNum+1
+    acgt = np.array([ord(b) for b in "ACGT"], dtype=np.uint8)
+    def Chunks():
+        for chrom, records in GetBinaryTensorBlock(fo):
+            seqCode = np.ascontiguousarray(records["seq"]).view(np.uint8).reshape(-1, windowLen)
+            records = records[np.in1d(seqCode[:,param.flankingBaseNum], acgt)] # TODO: Support IUPAC in the future
+            yield ["%s:%d:%s" % (chrom, p, s) for p, s in itertools.izip(records["pos"].tolist(), records["seq"].tolist())], records["counts"]
+    return FillBatches( Chunks(), num, numBuffers )
+
+def GetTensor( tensor_fn, num, tensor_fh = None, numBuffers = 0 ):
+    # Text or binary tensors, told apart by param.tensorMagic. With numBuffers, the batches are written into a ring of
+    # numBuffers arrays allocated once, see FillBatches
+    if tensor_fh == None and tensor_fn != "PIPE":
+        with open(tensor_fn, "rb") as f:
+            head = f.read(len(param.tensorMagic))
+        if head == param.tensorMagic:
+            fo = open(tensor_fn, "rb")
+            fo.read(len(param.tensorMagic))
+            return BatchBinaryTensor( fo, num, numBuffers )
+        return BatchTextTensor( BGZF.OpenInput(tensor_fn), num, numBuffers, closeAfter = True )
+
+    fo = tensor_fh if tensor_fh != None else sys.stdin
+    head = fo.read(len(param.tensorMagic))
+    if head == param.tensorMagic:
+        return BatchBinaryTensor( fo, num, numBuffers )
+    if len(head) != 0:
+        head += fo.readline()
+    return BatchTextTensor( itertools.chain([head] if len(head) != 0 else [], fo), num, numBuffers )
+
 
 def GetTrainingArray( tensor_fn, var_fn, bed_fn, shuffle = True ):
     tree = {}
     if bed_fn != None:
-        f = subprocess.Popen(shlex.split("gzip -fdc %s" % (bed_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
-        for row in f.stdout:
+        f = BGZF.OpenInput(bed_fn)
+        for row in f:
             row = row.split()
             name = row[0]
             if name not in tree:
@@ -72,13 +203,12 @@ def GetTrainingArray( tensor_fn, var_fn, bed_fn, shuffle = True ):
             begin = int(row[1])
             end = int(row[2])
             tree[name].addi(begin, end)
-        f.stdout.close()
-        f.wait()
+        f.close()
 
     Y = {}
     if var_fn != None:
-        f = subprocess.Popen(shlex.split("gzip -fdc %s" % (var_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
-        for row in f.stdout:
+        f = BGZF.OpenInput(var_fn)
+        for row in f:
             row = row.split()
             ctgName = row[0]
             pos = int(row[1])
@@ -117,14 +247,13 @@ def GetTrainingArray( tensor_fn, var_fn, bed_fn, shuffle = True ):
             else: baseVec[10+varLen] = 1.
 
             Y[key] = baseVec
-        f.stdout.close()
-        f.wait()
+        f.close()
 
     X = {}
-    f = subprocess.Popen(shlex.split("gzip -fdc %s" % (tensor_fn) ), stdout=subprocess.PIPE, bufsize=8388608)
+    f = BGZF.OpenInput(tensor_fn)
     total = 0
     mat = np.empty(((2*param.flankingBaseNum+1)*4*param.matrixNum), dtype=np.float32)
-    for row in f.stdout:
+    for row in f:
         chrom, coord, seq, mat = UnpackATensorRecord(*(row.split()))
         if bed_fn != None:
             if chrom not in tree: continue
@@ -148,8 +277,7 @@ def GetTrainingArray( tensor_fn, var_fn, bed_fn, shuffle = True ):
 
         total += 1
         if total % 100000 == 0: print >> sys.stderr, "Processed %d tensors" % total
-    f.stdout.close()
-    f.wait()
+    f.close()
 
     allPos = sorted(X.keys())
     if shuffle == True:
@@ -5,10 +5,13 @@ import param
 import shlex
 import subprocess
 import multiprocessing
-from threading import Thread
-import signal
-import random
+from threading import Thread, Lock
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
+from collections import deque
 import time
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../dataPrepScripts")
+import BGZF
 
 chroms = {"chr"+str(i) for i in range(1,23)}.union(str(i) for i in range(1,23)).union(["X","Y","chrX","chrY"])
 
@@ -19,32 +22,51 @@ class InstancesClass(object):
     def init(self):
         self.GTInstance = None
         self.CTSInstance = None
-        self.VVInstance = None
 
     def poll(self):
         self.GTInstance.poll()
         self.CTSInstance.poll()
-        self.VVInstance.poll()
-c = InstancesClass();
 
+    def kill(self):
+        for instance in (self.GTInstance, self.CTSInstance):
+            if instance != None and instance.returncode == None:
+                try:
+                    instance.kill()
+                except OSError:
+                    pass
+
+    def CheckRtCode(self):
+        self.poll()
+        if self.GTInstance.returncode != None and self.GTInstance.returncode != 0:
+            self.kill()
+            return "GetTruth.py exited with exceptions. Exiting..."
+
+        if self.CTSInstance.returncode != None and self.CTSInstance.returncode != 0:
+            self.kill()
+            return "CreateTensorsSites.py exited with exceptions. Exiting..."
 
-def CheckRtCode(signum, frame):
-    c.poll()
-    #print >> sys.stderr, c.GTInstance.returncode, c.CTSInstance.returncode, c.VVInstance.returncode
-    if c.GTInstance.returncode != None and c.GTInstance.returncode != 0:
-        c.CTSInstance.kill(); c.VVInstance.kill()
-        sys.exit("GetTruth.py exited with exceptions. Exiting...");
+        return None
 
-    if c.CTSInstance.returncode != None and c.CTSInstance.returncode != 0:
-        c.GTInstance.kill(); c.VVInstance.kill()
-        sys.exit("CreateTensorsSites.py exited with exceptions. Exiting...");
 
-    if c.VVInstance.returncode != None and c.VVInstance.returncode != 0:
-        c.GTInstance.kill(); c.CTSInstance.kill()
-        sys.exit("clairvoyante_test.py exited with exceptions. Exiting...");
+runningInstances = []
+runningInstancesLock = Lock()
 
-    if c.GTInstance.returncode == None or c.CTSInstance.returncode == None or c.VVInstance.returncode == None:
-        signal.alarm(5)
+def Exit(error):
+    with runningInstancesLock:
+        for c in runningInstances:
+            c.kill()
+    sys.exit(error)
+
+
+def CheckRtCode():
+    with runningInstancesLock:
+        instances = list(runningInstances)
+    for c in instances:
+        if c.GTInstance == None or c.CTSInstance == None:
+            continue
+        error = c.CheckRtCode()
+        if error != None:
+            Exit(error)
 
 
 def CheckFileExist(fn, sfx=""):
@@ -61,17 +83,159 @@ def CheckCmdExist(cmd):
     return cmd
 
 
+def PlanShards(ctgName, inputs, shardSize):
+    # Cut a contig into regions with balanced number of variants. As in CreateTensorSites.SplitCandidates, a cut
+    # is only placed at a gap wider than the read regions around the sites, the tensor of a site also depends on
+    # the candidates nearby, so a shard gives the same tensors as the whole contig
+    numShards = (len(inputs) + shardSize - 1) / shardSize if shardSize > 0 else 1
+    targetSize = (len(inputs) + numShards - 1) / numShards
+    shards = []
+    rows = []
+    previousPos = -1
+    for row in inputs:
+        pos = int(row.split(None, 2)[1])
+        if len(rows) >= targetSize and pos - previousPos > 2 * param.expandReadsRegion:
+            shards.append(rows)
+            rows = []
+        rows.append(row)
+        previousPos = pos
+    if len(rows) != 0:
+        shards.append(rows)
+    # ctgStart is 0-based and ctgEnd is inclusive, as accepted by GetTruth.py and CreateTensorSites.py
+    return [(ctgName, int(rows[0].split(None, 2)[1]) - 1, int(rows[-1].split(None, 2)[1]), rows) for rows in shards]
+
+
+def ProcessVCFRecord(row):
+    last = row[-1]
+    p1, p2 = 0, 0
+    if last.split(":")[0].find("/") != -1 or last.split(":")[0].find("|") != -1:
+        varType = last.split(":")[0].replace("/","|").replace(".","0").split("|")
+        p1, p2 = [int(x) for x in varType]
+        p1, p2 = (p1, p2) if p1 < p2 else (p2, p1)
+    else:
+        varType = last.split(":")[0].replace(".","0")
+        p1 = p2 = int(varType)
+    multi = 0
+    if p1 == 1 and p2 == 2:
+        multi = 1
+    return (multi, row[3], row[5], "\t".join([row[4], "/".join([str(p1), str(p2)])]))
+
+
+def ValidateShard(inputs, outputs, val_fh, debug = False):
+    # Merge-join the input VCF records and the Clairvoyante calls of a shard, both sorted by position.
+    # Only the first record at a position is validated, inputs without a call are reported as 'S'
+    iterOutputs = iter(outputs)
+    outputA = None; preOutPos = -1
+    preInPos = -1
+    for row in inputs:
+        inputA = row.strip().split()
+        inPos = int(inputA[1])
+        if inPos == preInPos:
+            continue
+        preInPos = inPos
+        while True:
+            if outputA == None:
+                try:
+                    outputA = next(iterOutputs).strip().split()
+                except StopIteration:
+                    outputA = -1
+            if outputA == -1:
+                break
+            outPos = int(outputA[1])
+            if debug == True:
+                print >> sys.stderr, inputA[0], inPos, outputA[0], outPos
+            if outPos <= preOutPos:
+                print >> sys.stderr, "Skipped position %s:%s in the output" % (outputA[0], outputA[1])
+                outputA = None
+                continue
+            if outPos < inPos:
+                Exit("Please make sure your VCF input is sorted. Skyhawk exited (3).\n%s\n%s" % (inputA, outputA))
+            break
+        multi, refAllele, _, pi = ProcessVCFRecord(inputA)
+        if multi == 1:
+            print >> val_fh, "B\t0\t%s\t%d\t%s\t%s" % (inputA[0], inPos, refAllele, pi)
+        elif outputA == -1 or int(outputA[1]) != inPos:
+            print >> val_fh, "S\t0\t%s\t%d\t%s\t%s" % (inputA[0], inPos, refAllele, pi)
+        else:
+            _, _, qual, po = ProcessVCFRecord(outputA)
+            if pi == po:
+                print >> val_fh, "M\t%s\t%s\t%d\t%s\t%s\t%s" % (qual, inputA[0], inPos, refAllele, pi, po)
+            else:
+                print >> val_fh, "X\t%s\t%s\t%d\t%s\t%s\t%s" % (qual, inputA[0], inPos, refAllele, pi, po)
+        if outputA != -1 and int(outputA[1]) == inPos:
+            preOutPos = inPos
+            outputA = None
+
+
+def ValidateEnsembleShard(inputs, outputsList, val_fh, modelVal_fhs, minAgree, debug = False):
+    # Validate a shard with the calls of each model into modelVal_fhs, and write the consensus to val_fh. A variant is
+    # validated (M) if at least minAgree models validate it, otherwise it is X with the call made by the most of the
+    # models not validating it. The decisions of the models are appended to each row, in the order of the models
+    results = []
+    for outputs, modelVal_fh in zip(outputsList, modelVal_fhs):
+        shardVal_fh = StringIO()
+        ValidateShard(inputs, outputs, shardVal_fh, debug)
+        rows = shardVal_fh.getvalue().splitlines()
+        modelVal_fh.writelines(row + "\n" for row in rows)
+        results.append([row.split("\t") for row in rows])
+    for rows in zip(*results):
+        decisions = [row[0] for row in rows]
+        consensus = rows[0]
+        if all(d in ("M", "X") for d in decisions):
+            if decisions.count("M") >= minAgree:
+                consensus = rows[decisions.index("M")]
+            else:
+                xRows = [row for row in rows if row[0] == "X"]
+                calls = [row[7:] for row in xRows]
+                consensus = xRows[calls.index(max(calls, key=calls.count))]
+        print >> val_fh, "%s\t%s" % ("\t".join(consensus), ",".join(decisions))
+
+
+inProcessWorker = {}
+
+def InitInProcessWorker(chkpnt_fns, numThreads):
+    import utils_v2 as utils
+    import clairvoyante_test as vv
+    utils.SetupEnv()
+    param.NUM_THREADS = numThreads
+    inProcessWorker["modelPools"] = [vv.ModelPool(chkpnt_fn, 1) for chkpnt_fn in chkpnt_fns]
+
+
+def RunOnACtgInProcess(args, ctsArgs, ctgName, ctgStart, ctgEnd, inputs):
+    # GetTruth.py, CreateTensorSites.py and the model chained as generators, the tensors are passed as NumPy arrays
+    import numpy as np
+    import utils_v2 as utils
+    import clairvoyante_test as vv
+    import GetTruth as gt
+    import CreateTensorSites as cts
+    print >> sys.stderr, "Working on chromosome: %s:%d-%d" % (ctgName, ctgStart+1, ctgEnd)
+    call_fhs = [StringIO() for modelPool in inProcessWorker["modelPools"]]
+    try:
+        ctsArgs = argparse.Namespace(ctgName = ctgName, ctgStart = ctgStart, ctgEnd = ctgEnd, **vars(ctsArgs))
+        refSeq = cts.LoadReference(ctsArgs)
+        canSites = [int(record[1]) for record in gt.ConvertVariants(inputs, ctgName, ctgStart + 1, ctgEnd)]
+        tensors = ((chrom, str(center), refWindow, np.array(alnCode, dtype=np.float32))\
+                   for chrom, center, refWindow, alnCode in cts.GenerateTensorsCached(ctsArgs, canSites, refSeq))
+        vv.TestBatch(args, inProcessWorker["modelPools"], utils.BatchTensor(tensors, param.predictBatchSize, numBuffers = 2), call_fhs)
+    except (Exception, SystemExit) as e:
+        print >> sys.stderr, e
+        return "Failed to validate the variants on %s. Exiting..." % (ctgName), []
+    return None, [call_fh.getvalue().splitlines(True) for call_fh in call_fhs]
+
+
 def Run(args):
     # --------------------------------------- Parameter check
     basedir = os.path.dirname(__file__)
     GTBin = CheckFileExist(basedir + "/../dataPrepScripts/GetTruth.py")
     CTSBin = CheckFileExist(basedir + "/../dataPrepScripts/CreateTensorSites.py")
-    VVBin = CheckFileExist(basedir + "/clairvoyante_test.py")
+    RCBin = CheckFileExist(basedir + "/../dataPrepScripts/RefCache.py")
     pypyBin = CheckCmdExist(args.pypy)
     if pypyBin == -1 : pypyBin = "python"
+    # pysam and numpy are not available to pypy
+    ctsBin = "python" if args.pysam == True or args.vectorized == True else pypyBin
     samtoolsBin = CheckCmdExist(args.samtools)
     if samtoolsBin == -1 : sys.exit("samtools not found")
-    chkpnt_fn = CheckFileExist(args.chkpnt_fn, sfx=".meta")
+    chkpnt_fns = [CheckFileExist(chkpnt_fn, sfx="" if os.path.splitext(chkpnt_fn)[1] in (".npz", ".pb") else ".meta") for chkpnt_fn in args.chkpnt_fn]
     bam_fn = CheckFileExist(args.bam_fn)
     ref_fn = CheckFileExist(args.ref_fn)
     fai_fn = CheckFileExist(args.ref_fn + ".fai")
@@ -80,76 +244,163 @@ def Run(args):
     sampleName = args.sampleName
     dcov = args.dcov
 
-    maxCpus = multiprocessing.cpu_count()
+    # Build the reference cache once, all CreateTensorSites map it read-only
+    refCache_fn = None
+    if args.refCache == True:
+        refCache_fn = ref_fn + ".refcache"
+        if not os.path.isfile(refCache_fn) or os.path.getmtime(refCache_fn) < os.path.getmtime(ref_fn):
+            print >> sys.stderr, "Building reference cache: %s" % (refCache_fn)
+            if subprocess.call(shlex.split("%s %s --ref_fn %s --cache_fn %s" % (pypyBin, RCBin, ref_fn, refCache_fn))) != 0:
+                sys.exit("Failed to build the reference cache %s" % (refCache_fn))
+    cacheOpt = "" if refCache_fn == None else " --refCache_fn %s" % (refCache_fn)
+    tensorCache_fn = None if args.tensorCache_fn == None else os.path.abspath(args.tensorCache_fn)
+    if tensorCache_fn != None:
+        cacheOpt += " --tensorCache_fn %s --tensorCacheSize %d" % (tensorCache_fn, args.tensorCacheSize)
+
     if args.threads == None: numCpus = multiprocessing.cpu_count()
     else: numCpus = args.threads if args.threads < multiprocessing.cpu_count() else multiprocessing.cpu_count()
-    cpuSet = ",".join(str(x) for x in random.sample(xrange(0, maxCpus), numCpus))
-    taskSet = "taskset -c %s"
-    try:
-        subprocess.check_output("which %s" % (taskset), shell=True)
-    except:
-        taskSet = ""
+    numParallel = args.parallel if args.parallel > 1 else 1
+    numModels = args.inferenceWorkers if args.inferenceWorkers > 1 else 1
+    # The models of an ensemble predict concurrently, each with numModels instances
+    numInstances = numModels * len(chkpnt_fns)
+    # Use the batch size and thread numbers calibrated by calibrate.py on this host for the same CPU budget and number of models
+    import calibrate
+    profile = calibrate.LoadProfile(args.profile_fn, numCpus, numParallel if args.inProcess == True else numInstances)
+    if profile != None:
+        calibrate.ApplyProfile(profile)
+        print >> sys.stderr, "Using the calibrated batchSize %d, intraThreads %d and interThreads %d" % (param.predictBatchSize, param.NUM_THREADS, param.NUM_INTER_THREADS)
+    # ---------------------------------------
+
+    # --------------------------------------- Load the model once, shared by all contigs and shards
+    import utils_v2 as utils
+    import clairvoyante_test as vv
+    if args.inProcess == False:
+        utils.SetupEnv()
+        # Split the CPU budget evenly among the inference workers of all the models
+        if profile == None:
+            param.NUM_THREADS = numCpus / numInstances if numCpus >= numInstances else 1
+        modelPools = [vv.ModelPool(chkpnt_fn, numModels) for chkpnt_fn in chkpnt_fns]
+    else:
+        ctsArgs = argparse.Namespace(bam_fn = bam_fn, ref_fn = ref_fn, samtools = samtoolsBin, dcov = dcov, pysam = args.pysam, vectorized = args.vectorized, refCache_fn = refCache_fn,
+                                     maxDepth = args.maxDepth, seed = args.seed,
+                                     excludeFlags = args.excludeFlags, minMQ = args.minMQ, workers = 1,
+                                     tensorCache_fn = tensorCache_fn, tensorCacheSize = args.tensorCacheSize)
     # ---------------------------------------
 
     # --------------------------------------- Divide VCF into choromosomes, then process
-    def RunOnACtg(ctgName, inputs, outputs):
+    def RunOnACtg(ctgName, ctgStart, ctgEnd, inputs):
+        print >> sys.stderr, "Working on chromosome: %s:%d-%d" % (ctgName, ctgStart+1, ctgEnd)
+        c = InstancesClass()
         try:
-            c.init()
             c.GTInstance = subprocess.Popen(\
-                shlex.split("%s %s --ctgName %s" %\
-                            (pypyBin, GTBin, ctgName) ),\
+                shlex.split("%s %s --ctgName %s --ctgStart %d --ctgEnd %d" %\
+                            (pypyBin, GTBin, ctgName, ctgStart, ctgEnd) ),\
                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr, bufsize=8388608)
             c.CTSInstance = subprocess.Popen(\
-                shlex.split("%s %s --bam_fn %s --ref_fn %s --ctgName %s --samtools %s --dcov %d" %\
-                            (pypyBin, CTSBin, bam_fn, ref_fn, ctgName, samtoolsBin, dcov) ),\
+                shlex.split("%s %s --bam_fn %s --ref_fn %s --ctgName %s --ctgStart %d --ctgEnd %d --samtools %s --dcov %d --pysam %s --vectorized %s --tensorFormat %s --maxDepth %d --seed %d --excludeFlags %d --minMQ %d%s" %\
+                            (ctsBin, CTSBin, bam_fn, ref_fn, ctgName, ctgStart, ctgEnd, samtoolsBin, dcov, args.pysam, args.vectorized, "binary" if args.binaryTensor == True else "text", args.maxDepth, args.seed, args.excludeFlags, args.minMQ, cacheOpt) ),\
                             stdin=c.GTInstance.stdout, stdout=subprocess.PIPE, stderr=sys.stderr, bufsize=8388608)
-            c.VVInstance = subprocess.Popen(\
-                shlex.split("%s python %s --chkpnt_fn %s --sampleName %s --threads %d" %\
-                            (taskSet, VVBin, chkpnt_fn, sampleName, numCpus) ),\
-                            stdin=c.CTSInstance.stdout, stdout=subprocess.PIPE, stderr=sys.stderr, bufsize=8388608)
         except Exception as e:
             print >> sys.stderr, e
-            sys.exit("Failed to start required processes. Exiting...")
+            c.kill()
+            return "Failed to start required processes. Exiting...", []
 
-        signal.signal(signal.SIGALRM, CheckRtCode)
-        signal.alarm(2)
+        with runningInstancesLock:
+            runningInstances.append(c)
 
         def put(fh, inputs):
-            for row in inputs:
-                fh.write(row)
-            fh.close()
-
-        def get(fh, outputs):
-            for row in fh:
-                outputs.append(row)
+            try:
+                for row in inputs:
+                    fh.write(row)
+                fh.close()
+            except IOError:
+                pass # The pipeline has failed, CheckRtCode will report it
 
         putThread = Thread(target = put, args = (c.GTInstance.stdin, inputs, ))
-        getThread = Thread(target = get, args = (c.VVInstance.stdout, outputs, ))
         putThread.start()
-        getThread.start()
+
+        error = None
+        call_fhs = [StringIO() for modelPool in modelPools]
+        try:
+            vv.TestStream(args, modelPools, utils, c.CTSInstance.stdout, call_fhs)
+        except Exception as e:
+            print >> sys.stderr, e
+            c.kill()
+            error = "Failed to validate the variants on %s. Exiting..." % (ctgName)
 
         putThread.join()
-        getThread.join()
-        c.VVInstance.stdout.close()
-        c.VVInstance.wait()
         c.CTSInstance.stdout.close()
         c.CTSInstance.wait()
         c.GTInstance.stdout.close()
         c.GTInstance.wait()
-        signal.alarm(0)
 
-    headers = []
-    allOutputs = []
-    allInputs = []
+        with runningInstancesLock:
+            runningInstances.remove(c)
+        rtError = c.CheckRtCode()
+        return error if error != None else rtError, [call_fh.getvalue().splitlines(True) for call_fh in call_fhs]
+
+    # --------------------------------------- Output Clairvoyante calls to VCF and validation results as the shards complete
+    if args.inProcess == False:
+        pool = ThreadPool(numParallel)
+    elif numParallel == 1:
+        # Everything in this process
+        InitInProcessWorker(chkpnt_fns, numCpus if profile == None else param.NUM_THREADS)
+        pool = ThreadPool(1)
+    else:
+        # One process per concurrent shard, each loads the model once
+        pool = multiprocessing.Pool(numParallel, InitInProcessWorker, (chkpnt_fns, param.NUM_THREADS if profile != None else numCpus / numParallel if numCpus >= numParallel else 1))
+    # At most maxPending shards are read ahead, the memory used is bounded by one contig plus the pending shards
+    maxPending = 2 * numParallel
+    pending = deque()
+    val_fh = open(val_fn, "w")
+    # With several models, the consensus goes to val_fn, and the results and calls of each model to files suffixed
+    # with .model1, .model2 ... in the order of --chkpnt_fn
+    numEnsemble = len(chkpnt_fns)
+    minAgree = args.minAgree if args.minAgree > 0 else numEnsemble / 2 + 1
+    modelVal_fhs = [open("%s.model%d" % (val_fn, i+1), "w") for i in range(numEnsemble)] if numEnsemble > 1 else []
+    outputVCF_fhs = []
+    if args.outputVCF_fn != None:
+        outputVCF_fhs = [open(args.outputVCF_fn if numEnsemble == 1 else "%s.model%d" % (args.outputVCF_fn, i+1), "w") for i in range(numEnsemble)]
+
+    def Flush(maxPending):
+        while len(pending) > maxPending:
+            inputs, job = pending.popleft()
+            outputsList = [[] for i in range(numEnsemble)]
+            if job != None:
+                while not job.ready():
+                    CheckRtCode()
+                    job.wait(2)
+                error, outputsList = job.get()
+                if error != None:
+                    Exit(error)
+            for outputVCF_fh, outputs in zip(outputVCF_fhs, outputsList):
+                outputVCF_fh.writelines(outputs)
+            if numEnsemble == 1:
+                ValidateShard(inputs, outputsList[0], val_fh, args.debug)
+            else:
+                ValidateEnsembleShard(inputs, outputsList, val_fh, modelVal_fhs, minAgree, args.debug)
+
+    def Submit(ctgName, inputs, flag):
+        if flag == 1:
+            for shard in PlanShards(ctgName, inputs, args.shardSize):
+                Flush(maxPending - 1)
+                if args.inProcess == False:
+                    pending.append((shard[3], pool.apply_async(RunOnACtg, shard)))
+                else:
+                    pending.append((shard[3], pool.apply_async(RunOnACtgInProcess, (args, ctsArgs) + shard)))
+        else:
+            pending.append((inputs, None))
+
     inputs = []
-    outputs = []
     previousCtg = ""
+    previousPos = -1
     flag = 1
-    vcf_fh = subprocess.Popen(shlex.split("gzip -dcf %s" % (vcf_fn) ), stdout=subprocess.PIPE, bufsize=65536)
-    for row in vcf_fh.stdout:
+    vcf_fh = BGZF.OpenInput(vcf_fn)
+    for row in vcf_fh:
         rowA = row.strip().split()
         if rowA[0][0] == "#":
-            headers.append(row)
+            for outputVCF_fh in outputVCF_fhs:
+                outputVCF_fh.write(row)
             continue
         if rowA[0] != previousCtg:
             if args.allChrom == False:
@@ -157,118 +408,31 @@ def Run(args):
                     flag = 0
                 else:
                     flag = 1
-            if flag == 1 and len(inputs) != 0:
-                print >> sys.stderr, "Working on chromosome: %s" % (previousCtg)
-                RunOnACtg(previousCtg, inputs, outputs)
-                for item in outputs:
-                    allOutputs.append(item)
-            outputs = []
+            if len(inputs) != 0:
+                Submit(previousCtg, inputs, flag)
             inputs = []
             previousCtg = rowA[0]
+            previousPos = -1
+        elif int(rowA[1]) < previousPos:
+            Exit("Please make sure your VCF input is sorted. Skyhawk exited (1).\n%s" % (row))
+        previousPos = int(rowA[1])
         inputs.append(row)
-        allInputs.append(row)
     if args.allChrom == False:
         if previousCtg not in chroms:
             flag = 0
         else:
             flag = 1
-    if flag == 1 and len(inputs) != 0:
-        print >> sys.stderr, "Working on chromosome: %s" % (previousCtg)
-        RunOnACtg(previousCtg, inputs, outputs)
-        for item in outputs:
-            allOutputs.append(item)
-    # ---------------------------------------
-
-    # --------------------------------------- Output Clairvoyante calls to VCF
-    if args.outputVCF_fn != None:
-        outputVCF_fh = open(args.outputVCF_fn, "w")
-        for row in headers:
-            outputVCF_fh.write(row)
-        for row in allOutputs:
-            outputVCF_fh.write(row)
-    # ---------------------------------------
-
-    # --------------------------------------- Result analysis section
-    def ProcessVCFRecord(row):
-        last = row[-1]
-        p1, p2 = 0, 0
-        if last.split(":")[0].find("/") != -1 or last.split(":")[0].find("|") != -1:
-            varType = last.split(":")[0].replace("/","|").replace(".","0").split("|")
-            p1, p2 = [int(x) for x in varType]
-            p1, p2 = (p1, p2) if p1 < p2 else (p2, p1)
-        else:
-            varType = last.split(":")[0].replace(".","0")
-            p1 = p2 = int(varType)
-        multi = 0
-        if p1 == 1 and p2 == 2:
-            multi = 1
-        return (multi, row[3], row[5], "\t".join([row[4], "/".join([str(p1), str(p2)])]))
-
-    preInChr = ""; preInPos = -1
-    preOutChr = ""; preOutPos = -1
-    val_fh = open(val_fn, "w")
-    iterAllOutputs = iter(allOutputs)
-    iterAllInputs = iter(allInputs)
-    inputA = next(iterAllInputs).strip().split()
-    for output in iterAllOutputs:
-        outputA = output.strip().split()
-        if preOutChr != outputA[0]:
-            preOutChr = outputA[0]
-            preOutPos = int(outputA[1])
-        elif preOutPos <= int(outputA[1]):
-            preOutPos = int(outputA[1])
-        else:
-            print >> sys.stderr, "Skipped position %s:%s in the output" % (outputA[0], outputA[1])
-            continue
-        #print >> sys.stderr, "0", inputA[0], inputA[1], outputA[0], outputA[1]
-        while inputA != -1 and (inputA[0] != outputA[0] or int(inputA[1]) < int(outputA[1])):
-            multi, refAllele, _, pi = ProcessVCFRecord(inputA)
-            if multi == 1:
-                print >> val_fh, "B\t0\t%s\t%d\t%s\t%s" % (inputA[0], int(inputA[1]), refAllele, pi)
-            else:
-                print >> val_fh, "S\t0\t%s\t%d\t%s\t%s" % (inputA[0], int(inputA[1]), refAllele, pi)
-            while True:
-                try:
-                    inputA = next(iterAllInputs).strip().split()
-                    if args.debug == 1:
-                        print >> sys.stderr, "1", inputA[0], inputA[1], outputA[0], outputA[1]
-                except StopIteration:
-                    inputA = -1
-                    break
-                if inputA[0] == preInChr and int(inputA[1]) < preInPos:
-                    print >> sys.stderr, "Please make sure your VCF input is sorted. Skyhawk exited (1).\n%s\n%s" % (inputA, outputA)
-                    sys.exit(-1)
-                if inputA[0] != preInChr or int(inputA[1]) != preInPos:
-                    preInChr = inputA[0]; preInPos = int(inputA[1])
-                    break;
-        if inputA[0] == outputA[0] and int(inputA[1]) == int(outputA[1]):
-            multi, refAllele, _, pi = ProcessVCFRecord(inputA)
-            _, _, qual, po = ProcessVCFRecord(outputA)
-            if multi == 1:
-                print >> val_fh, "B\t0\t%s\t%d\t%s\t%s" % (inputA[0], int(inputA[1]), refAllele, pi)
-            elif pi == po:
-                print >> val_fh, "M\t%s\t%s\t%d\t%s\t%s\t%s" % (qual, inputA[0], int(inputA[1]), refAllele, pi, po)
-            else:
-                print >> val_fh, "X\t%s\t%s\t%d\t%s\t%s\t%s" % (qual, inputA[0], int(inputA[1]), refAllele, pi, po)
-            while True:
-                try:
-                    inputA = next(iterAllInputs).strip().split()
-                    if args.debug == 1:
-                        print >> sys.stderr, "2", inputA[0], inputA[1], outputA[0], outputA[1]
-                except StopIteration:
-                    inputA = -1
-                    break
-                if inputA[0] == preInChr and int(inputA[1]) < preInPos:
-                    print >> sys.stderr, "Please make sure your VCF input is sorted. Skyhawk exited (2).\n%s\n%s" % (inputA, outputA)
-                    sys.exit(-1)
-                if inputA[0] != preInChr or int(inputA[1]) != preInPos:
-                    preInChr = inputA[0]; preInPos = int(inputA[1])
-                    break;
-        elif inputA == -1:
-            break
-        else:
-            print >> sys.stderr, "Please make sure your VCF input is sorted. Skyhawk exited (3).\n%s\n%s" % (inputA, outputA)
-            sys.exit(-1)
+    if len(inputs) != 0:
+        Submit(previousCtg, inputs, flag)
+    inputs = []
+    vcf_fh.close()
+    pool.close()
+
+    Flush(0)
+    pool.join()
+    val_fh.close()
+    for fh in modelVal_fhs + outputVCF_fhs:
+        fh.close()
     # ---------------------------------------
 
 
@@ -277,8 +441,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
             description="Skyhawk: An Artificial Neural Network-based discriminator for validating clinically significant genomic variants" )
 
-    parser.add_argument('--chkpnt_fn', type=str, default = None,
-            help="Input a Clairvoyante model")
+    parser.add_argument('--chkpnt_fn', type=str, nargs='+', default = None,
+            help="Input a Clairvoyante model, its weights exported to .npz by clairvoyante_np.py or its graph exported to .pb by freezeModel.py. With several models, each tensor is validated by all of them and a consensus is output")
+
+    parser.add_argument('--minAgree', type=int, default = 0,
+            help="With several models, the number of models validating a variant for a consensus M, 0 for a majority, default: %(default)s")
 
     parser.add_argument('--ref_fn', type=str, default="ref.fa",
             help="Reference fasta input, default: %(default)s")
@@ -304,11 +471,56 @@ if __name__ == "__main__":
     parser.add_argument('--threads', type=int, default = None,
             help="Number of threads, optional")
 
+    parser.add_argument('--parallel', type=int, default = 1,
+            help="Number of contigs or shards to be processed concurrently, default: %(default)s")
+
+    parser.add_argument('--shardSize', type=int, default = param.shardSize,
+            help="Split a contig into shards of about this number of variants, 0 to disable, default: %(default)s")
+
+    parser.add_argument('--inferenceWorkers', type=int, default = 1,
+            help="Number of model instances loaded for inference, shared by all contigs and shards, the threads are divided among them, default: %(default)s")
+
+    parser.add_argument('--profile_fn', type=str, default = None,
+            help="Batch size and thread numbers calibrated by calibrate.py, used if calibrated for the same threads and number of models, default: ~/.skyhawk/profile.<hostname>.json")
+
+    parser.add_argument('--inProcess', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Run GetTruth, CreateTensorSites and the model in the same process without text pipes, default: %(default)s")
+
     parser.add_argument('--dcov', type=int, default=8000,
             help="Cap depth per position at %(default)s")
 
+    parser.add_argument('--excludeFlags', type=int, default=0,
+            help="Skip the reads with any of these FLAG bits set, e.g. 3844 for unmapped, secondary, QC-fail, duplicate and supplementary reads, default: %(default)s")
+
+    parser.add_argument('--minMQ', type=int, default=0,
+            help="Skip the reads with a MAPQ below this, default: %(default)s")
+
+    parser.add_argument('--maxDepth', type=int, default=0,
+            help="Build each tensor from a random sample of at most this many reads, for ultra-deep panels, 0 to use all the reads, default: %(default)s")
+
+    parser.add_argument('--seed', type=int, default=0,
+            help="Random seed of --maxDepth, default: %(default)s")
+
     parser.add_argument('--samtools', type=str, default="samtools",
-            help="Path to the 'samtools', default: %(default)s")
+            help="Path to the 'samtools', version 1.8 or later, default: %(default)s")
+
+    parser.add_argument('--pysam', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Read the BAM through pysam instead of 'samtools view', default: %(default)s")
+
+    parser.add_argument('--vectorized', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Build the tensors with the vectorized NumPy engine, CreateTensorSites then runs in python instead of pypy, use it when pypy is not available, default: %(default)s")
+
+    parser.add_argument('--binaryTensor', type=param.str2bool, nargs='?', const=True, default=True,
+            help="Pass the tensors from CreateTensorSites to the model in the binary format instead of text, the text tensors of all the contigs are parsed in this process, default: %(default)s")
+
+    parser.add_argument('--refCache', type=param.str2bool, nargs='?', const=True, default=False,
+            help="Build a 2-bit packed reference cache next to the reference fasta once and share it memory-mapped among all workers, default: %(default)s")
+
+    parser.add_argument('--tensorCache_fn', type=str, default=None,
+            help="Persistent tensor cache shared by the runs on the same BAM and reference, only the sites not in the cache are built, disabled if not provided")
+
+    parser.add_argument('--tensorCacheSize', type=int, default=10240,
+            help="Size limit of the tensor cache in MB, the least recently used tensors are evicted beyond it, default: %(default)s")
 
     parser.add_argument('--pypy', type=str, default="pypy",
             help="Path to the 'pypy', default: %(default)s")
@@ -322,5 +534,8 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
+    if args.chkpnt_fn != None and args.minAgree > len(args.chkpnt_fn):
+        sys.exit("--minAgree %d is more than the %d models given to --chkpnt_fn" % (args.minAgree, len(args.chkpnt_fn)))
+
     Run(args)
 